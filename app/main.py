@@ -1,24 +1,161 @@
+import asyncio
+import fcntl
 import logging
+import os
+import secrets
 import sys
+import tempfile
+import threading
 import time
 from pathlib import Path
 from contextlib import asynccontextmanager
-from typing import Optional, List
+from typing import Annotated, Any, Dict, Generator, Iterator, Optional, Tuple
 
 # Ensure src/ is in the module path
 sys.path.append(str(Path(__file__).parent.parent / "src"))
 
-from fastapi import FastAPI, HTTPException, Request
+import httpx
+import orjson
+from anyio import to_thread
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
 
 from llm_chain import ClinicalRAGChain
+from batching import RequestBatcher
+from indexer import DATA_PATH, build_faiss_index, load_documents
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 rag_chain: Optional[ClinicalRAGChain] = None
+request_batcher: Optional[RequestBatcher] = None
+_chain_lock = threading.Lock()
+
+# Upper bound on concurrent blocking RAG calls dispatched to the worker threadpool
+THREADPOOL_SIZE = 64
+
+# /ask requests arriving within BATCH_MAX_WAIT_MS are retrieved together, up to BATCH_MAX_SIZE
+BATCH_MAX_SIZE = 32
+BATCH_MAX_WAIT_MS = 20
+BATCH_QUEUE_DEPTH = 256
+
+# Upper bound on the questions a client may coalesce into one /chat/batch call
+CHAT_BATCH_MAX_SIZE = 8
+
+# Pooled keep-alive connections to Groq shared by every request in this worker
+HTTP_TIMEOUT_S = 30
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=64, max_connections=128)
+
+# POST /reindex requires this token in X-Admin-Token and is disabled while it is unset
+REINDEX_TOKEN = os.getenv("REINDEX_TOKEN")
+
+# Precomputed /risk and /patient answers, stored inside the index build they were generated from
+ANSWERS_FILE = "answers.json"
+ANSWERS_LOCK_FILE = "answers.lock"
+
+RISK_QUERY = "Identify patients at elevated clinical risk. Categorize them into High, Medium, and Low risk cohorts."
+
+
+class ORJSONResponse(JSONResponse):
+    """JSON response rendered by the Rust orjson serializer."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+def load_rag_chain(http_client: httpx.Client, http_async_client: httpx.AsyncClient) -> ClinicalRAGChain:
+    """Build the RAG chain once per worker process; concurrent callers share the result."""
+    global rag_chain
+    with _chain_lock:
+        if rag_chain is None:
+            rag_chain = ClinicalRAGChain(
+                k=4, http_client=http_client, http_async_client=http_async_client, warmup=True
+            )
+    return rag_chain
+
+
+def patient_summary_query(pid: str) -> str:
+    return f"Please provide a comprehensive clinical summary for patient {pid}."
+
+
+async def precompute_answers(app: FastAPI) -> None:
+    """
+    /risk and /patient/{id} are pure functions of the indexed corpus, so their answers
+    are generated once here and served from app.state until the next reindex.
+    """
+    patient_ids = sorted(rag_chain.patient_ids)
+    queries = [RISK_QUERY] + [patient_summary_query(pid) for pid in patient_ids]
+    logger.info(f"Precomputing risk triage and {len(patient_ids)} patient summaries...")
+
+    results = await run_in_threadpool(rag_chain.ask_many, queries, True)
+    for query, result in zip(queries, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Precompute failed for '{query}': {str(result)}")
+
+    app.state.risk_answer = results[0] if not isinstance(results[0], BaseException) else None
+    app.state.patient_cache = {
+        pid: result
+        for pid, result in zip(patient_ids, results[1:])
+        if not isinstance(result, BaseException)
+    }
+    logger.info(f"Precomputed answers cached for {len(app.state.patient_cache)} patients.")
+
+def read_answers(path: Path) -> Optional[Dict[str, Any]]:
+    """Answers persisted for an index build, or None when absent or unreadable."""
+    try:
+        return orjson.loads(path.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+def write_answers(path: Path, answers: Dict[str, Any]) -> None:
+    """Write answers atomically so a worker never loads a partial file."""
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(answers))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def _lock_answers(lock_file) -> None:
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+async def load_or_precompute_answers(app: FastAPI) -> None:
+    """
+    Serve the loaded build's precomputed answers, generating them only if no worker has yet.
+    Workers take an exclusive lock in the build directory, so the first one pays the
+    1 + N LLM calls and the rest wait for it and read its file.
+    """
+    build_dir = Path(rag_chain.retriever.snapshot.loaded_from)
+    path = build_dir / ANSWERS_FILE
+    try:
+        lock_file = open(build_dir / ANSWERS_LOCK_FILE, "a")
+    except OSError as e:
+        logger.warning(f"Cannot lock precomputed answers in {build_dir}: {str(e)}")
+        await precompute_answers(app)
+        return
+
+    with lock_file:
+        await run_in_threadpool(_lock_answers, lock_file)
+        answers = await run_in_threadpool(read_answers, path)
+        if answers is not None:
+            if rag_chain.retriever.snapshot.loaded_from != str(build_dir):
+                return  # Reloaded again while waiting; the newer build's task takes over
+            app.state.risk_answer = answers["risk"]
+            app.state.patient_cache = answers["patients"]
+            logger.info(f"Loaded precomputed answers for {len(app.state.patient_cache)} patients from {path}")
+            return
+
+        await precompute_answers(app)
+        try:
+            answers = {"risk": app.state.risk_answer, "patients": app.state.patient_cache}
+            await run_in_threadpool(write_answers, path, answers)
+        except OSError as e:
+            logger.warning(f"Could not persist precomputed answers to {path}: {str(e)}")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -26,17 +163,40 @@ async def lifespan(app: FastAPI):
     Lifespan context manager for FastAPI.
     Initializes the RAG chain during startup and retains it in memory.
     """
-    global rag_chain
+    global request_batcher
     logger.info("Initializing Clinical RAG API service...")
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
+    # Threadpool calls use the sync client, batched async generation the async one
+    app.state.http = httpx.AsyncClient(http2=True, timeout=HTTP_TIMEOUT_S, limits=HTTP_LIMITS)
+    app.state.http_sync = httpx.Client(http2=True, timeout=HTTP_TIMEOUT_S, limits=HTTP_LIMITS)
     try:
-        rag_chain = ClinicalRAGChain(k=4)
+        await run_in_threadpool(load_rag_chain, app.state.http_sync, app.state.http)
+        await rag_chain.awarmup()
         logger.info("RAG chain successfully loaded and ready for inference.")
     except Exception as e:
         logger.error(f"Failed to initialize RAG chain: {str(e)}", exc_info=True)
         raise
-    
+
+    app.state.risk_answer = None
+    app.state.patient_cache = {}
+    app.state.reload_lock = asyncio.Lock()
+    app.state.answers_task = None
+    await load_or_precompute_answers(app)
+
+    request_batcher = RequestBatcher(
+        rag_chain,
+        max_batch_size=BATCH_MAX_SIZE,
+        max_wait_ms=BATCH_MAX_WAIT_MS,
+        max_queue_depth=BATCH_QUEUE_DEPTH
+    )
+    request_batcher.start()
+
     yield
     logger.info("Service shutting down...")
+    await request_batcher.stop()
+    await app.state.http.aclose()
+    app.state.http_sync.close()
 
 app = FastAPI(
     title="Clinical RAG Service API",
@@ -53,19 +213,31 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Frozen models skip assignment validation/copying; request models reject unknown fields
+MODEL_CONFIG = ConfigDict(str_strip_whitespace=True, frozen=True, extra="forbid", validate_assignment=False)
+
 class QuestionRequest(BaseModel):
+    model_config = MODEL_CONFIG
+
     question: str = Field(..., min_length=3, max_length=500)
     verbose: bool = Field(default=False)
 
 class ChatMessage(BaseModel):
+    model_config = MODEL_CONFIG
+
     role: str = Field(...)
     content: str = Field(...)
 
 class ChatRequest(BaseModel):
+    model_config = MODEL_CONFIG
+
     question: str = Field(..., min_length=3, max_length=500)
-    chat_history: List[ChatMessage] = Field(default=[])
+    chat_history: Tuple[ChatMessage, ...] = Field(default=())
+    session_id: Optional[str] = Field(default=None, max_length=64)
 
 class RAGResponse(BaseModel):
+    model_config = MODEL_CONFIG
+
     question: str
     answer: str
     model: str
@@ -73,22 +245,72 @@ class RAGResponse(BaseModel):
     context: Optional[str] = None
     latency_ms: float
 
+class ChatBatchRequest(BaseModel):
+    model_config = MODEL_CONFIG
+
+    questions: Tuple[Annotated[str, Field(min_length=3, max_length=500)], ...] = Field(..., min_length=1, max_length=CHAT_BATCH_MAX_SIZE)
+    chat_history: Tuple[ChatMessage, ...] = Field(default=())
+
+class ChatBatchResult(BaseModel):
+    """One /chat/batch answer; a question that failed carries only its error."""
+    model_config = MODEL_CONFIG
+
+    question: str
+    answer: Optional[str] = None
+    model: Optional[str] = None
+    chunks_retrieved: Optional[int] = None
+    latency_ms: float
+    error: Optional[str] = None
+
+class ChatBatchResponse(BaseModel):
+    model_config = MODEL_CONFIG
+
+    results: Tuple[ChatBatchResult, ...]
+
 class HealthResponse(BaseModel):
+    model_config = MODEL_CONFIG
+
     status: str
     model: str
     faiss_index: str
     version: str
 
+class PatientListResponse(BaseModel):
+    model_config = MODEL_CONFIG
+
+    patient_ids: Tuple[str, ...]
+
+async def refresh_stale_index() -> None:
+    """
+    Reload an index rebuilt by another worker: POST /reindex only reloads the worker that
+    served it, so every worker compares the index symlink's target before each request.
+    """
+    if rag_chain is None or not rag_chain.retriever.index_stale():
+        return
+    async with app.state.reload_lock:
+        if rag_chain.retriever.index_stale():
+            logger.info("FAISS index rebuilt by another worker; reloading...")
+            await run_in_threadpool(rag_chain.reload_index)
+            # Served lazily until the rebuilding worker's answers file can be read
+            app.state.risk_answer = None
+            app.state.patient_cache = {}
+            app.state.answers_task = asyncio.create_task(load_or_precompute_answers(app))
+
+@app.middleware("http")
+async def reload_stale_index(request: Request, call_next):
+    await refresh_stale_index()
+    return await call_next(request)
+
 @app.middleware("http")
 async def add_process_time_header(request: Request, call_next):
     """Middleware to inject execution time into response headers."""
-    start_time = time.time()
+    start_time = time.perf_counter_ns()
     response = await call_next(request)
-    process_time = round((time.time() - start_time) * 1000, 2)
-    response.headers["X-Process-Time"] = str(process_time)
+    process_time = (time.perf_counter_ns() - start_time) / 1e6
+    response.headers["X-Process-Time"] = f"{process_time:.2f}"
     return response
 
-@app.get("/", tags=["System"])
+@app.get("/", response_class=ORJSONResponse, tags=["System"])
 async def root():
     return {"message": "Clinical RAG API Service operational.", "docs_url": "/docs", "health_url": "/health"}
 
@@ -102,19 +324,21 @@ async def health_check():
 @app.post("/ask", response_model=RAGResponse, tags=["Inference"])
 async def ask_question(request: QuestionRequest):
     """Execute a single query against the RAG pipeline."""
-    if rag_chain is None:
+    if rag_chain is None or request_batcher is None:
         raise HTTPException(status_code=503, detail="Service unavailable.")
     
-    start_time = time.time()
+    start_time = time.perf_counter_ns()
     try:
-        result = rag_chain.ask(question=request.question)
+        result = await request_batcher.submit(request.question)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Inference queue saturated. Retry shortly.")
     except Exception as e:
         logger.error(f"Inference error on /ask endpoint: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail="Internal inference error.")
 
-    latency = round((time.time() - start_time) * 1000, 2)
+    latency = round((time.perf_counter_ns() - start_time) / 1e6, 2)
     return RAGResponse(
-        question=result["question"],
+        question=request.question,
         answer=result["answer"],
         model=result["model"],
         chunks_retrieved=result["chunks_retrieved"],
@@ -122,21 +346,52 @@ async def ask_question(request: QuestionRequest):
         latency_ms=latency
     )
 
+def sse_events(tokens: Generator[str, None, Dict[str, Any]], start_time: int) -> Iterator[str]:
+    """
+    Frame answer tokens as server-sent events, ending with a 'done' event that carries the
+    model and end-to-end latency.
+    """
+    try:
+        while True:
+            try:
+                token = next(tokens)
+            except StopIteration as done:
+                result = done.value
+                break
+            yield f"data: {orjson.dumps({'token': token}).decode()}\n\n"
+    except Exception as e:
+        logger.error(f"Streaming inference error: {str(e)}", exc_info=True)
+        yield "event: error\ndata: {}\n\n"
+        return
+
+    latency = round((time.perf_counter_ns() - start_time) / 1e6, 2)
+    yield f"event: done\ndata: {orjson.dumps({'model': result['model'], 'latency_ms': latency}).decode()}\n\n"
+
+@app.post("/ask/stream", tags=["Inference"])
+async def ask_question_stream(request: QuestionRequest):
+    """Stream the answer to a single query token by token as server-sent events."""
+    if rag_chain is None:
+        raise HTTPException(status_code=503, detail="Service unavailable.")
+
+    # StreamingResponse iterates this synchronous generator in the threadpool
+    tokens = rag_chain.stream(request.question)
+    return StreamingResponse(sse_events(tokens, time.perf_counter_ns()), media_type="text/event-stream")
+
 @app.post("/chat", response_model=RAGResponse, tags=["Inference"])
 async def chat(request: ChatRequest):
     """Execute a conversational query with memory context."""
     if rag_chain is None:
         raise HTTPException(status_code=503, detail="Service unavailable.")
 
-    start_time = time.time()
+    start_time = time.perf_counter_ns()
     try:
-        history = [{"role": m.role, "content": m.content} for m in request.chat_history]
-        result = rag_chain.ask_with_history(question=request.question, chat_history=history)
+        history = [m.model_dump() for m in request.chat_history]
+        result = await run_in_threadpool(rag_chain.ask_with_history, request.question, history, request.session_id)
     except Exception as e:
         logger.error(f"Inference error on /chat endpoint: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail="Internal chat inference error.")
 
-    latency = round((time.time() - start_time) * 1000, 2)
+    latency = round((time.perf_counter_ns() - start_time) / 1e6, 2)
     return RAGResponse(
         question=request.question,
         answer=result["answer"],
@@ -145,21 +400,62 @@ async def chat(request: ChatRequest):
         latency_ms=latency
     )
 
+@app.post("/chat/batch", response_model=ChatBatchResponse, response_model_exclude_none=True, tags=["Inference"])
+async def chat_batch(request: ChatBatchRequest):
+    """
+    Answer a burst of conversational queries sharing one history in a single batched pass.
+    A failed question is reported in its own result, so it does not fail its siblings.
+    """
+    if rag_chain is None:
+        raise HTTPException(status_code=503, detail="Service unavailable.")
+
+    start_time = time.perf_counter_ns()
+    history = [m.model_dump() for m in request.chat_history]
+    results = await run_in_threadpool(rag_chain.ask_many_with_history, list(request.questions), history)
+
+    latency = round((time.perf_counter_ns() - start_time) / 1e6, 2)
+    items = []
+    for question, result in zip(request.questions, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Inference error on /chat/batch endpoint for '{question}': {str(result)}")
+            items.append(ChatBatchResult(question=question, latency_ms=latency, error="Internal chat inference error."))
+            continue
+        items.append(ChatBatchResult(
+            question=question,
+            answer=result["answer"],
+            model=result["model"],
+            chunks_retrieved=result["chunks_retrieved"],
+            latency_ms=latency
+        ))
+    return ChatBatchResponse(results=tuple(items))
+
+@app.post("/chat/stream", tags=["Inference"])
+async def chat_stream(request: ChatRequest):
+    """Stream a conversational answer token by token as server-sent events."""
+    if rag_chain is None:
+        raise HTTPException(status_code=503, detail="Service unavailable.")
+
+    history = [m.model_dump() for m in request.chat_history]
+    tokens = rag_chain.stream_with_history(request.question, history, request.session_id)
+    return StreamingResponse(sse_events(tokens, time.perf_counter_ns()), media_type="text/event-stream")
+
 @app.get("/risk", response_model=RAGResponse, tags=["Analytics"])
 async def risk_triage():
     """Execute organization-wide risk stratification against all embedded records."""
     if rag_chain is None:
         raise HTTPException(status_code=503, detail="Service unavailable.")
 
-    start_time = time.time()
+    start_time = time.perf_counter_ns()
     try:
-        query = "Identify patients at elevated clinical risk. Categorize them into High, Medium, and Low risk cohorts."
-        result = rag_chain.ask(query)
+        result = app.state.risk_answer
+        if result is None:
+            result = await run_in_threadpool(rag_chain.ask, RISK_QUERY)
+            app.state.risk_answer = result
     except Exception as e:
         logger.error("Error executing risk triage", exc_info=True)
         raise HTTPException(status_code=500, detail="Risk analysis failed.")
 
-    latency = round((time.time() - start_time) * 1000, 2)
+    latency = round((time.perf_counter_ns() - start_time) / 1e6, 2)
     return RAGResponse(
         question="Comprehensive Risk Stratification",
         answer=result["answer"],
@@ -168,6 +464,13 @@ async def risk_triage():
         latency_ms=latency
     )
 
+@app.get("/patients", response_model=PatientListResponse, tags=["Analytics"])
+async def list_patients():
+    """List the patient IDs present in the index."""
+    if rag_chain is None:
+        raise HTTPException(status_code=503, detail="Service unavailable.")
+    return PatientListResponse(patient_ids=tuple(sorted(rag_chain.patient_ids)))
+
 @app.get("/patient/{patient_id}", response_model=RAGResponse, tags=["Analytics"])
 async def get_patient_summary(patient_id: str):
     """Retrieve synthesized clinical summary for a specific Patient ID."""
@@ -177,15 +480,20 @@ async def get_patient_summary(patient_id: str):
     pid = patient_id.upper().strip()
     if not pid.startswith("P") or not pid[1:].isdigit():
         raise HTTPException(status_code=422, detail="Invalid format for Patient ID. Expected format: P[0-9]+")
+    if pid not in rag_chain.patient_ids:
+        raise HTTPException(status_code=404, detail=f"Unknown patient: {pid}")
 
-    start_time = time.time()
+    start_time = time.perf_counter_ns()
     try:
-        result = rag_chain.ask(f"Please provide a comprehensive clinical summary for patient {pid}.")
+        result = app.state.patient_cache.get(pid)
+        if result is None:
+            result = await run_in_threadpool(rag_chain.ask, patient_summary_query(pid))
+            app.state.patient_cache[pid] = result
     except Exception as e:
         logger.error(f"Error executing summarize for PID {pid}", exc_info=True)
         raise HTTPException(status_code=500, detail="Patient summarization failed.")
 
-    latency = round((time.time() - start_time) * 1000, 2)
+    latency = round((time.perf_counter_ns() - start_time) / 1e6, 2)
     return RAGResponse(
         question=f"Clinical Summary: {pid}",
         answer=result["answer"],
@@ -194,10 +502,38 @@ async def get_patient_summary(patient_id: str):
         latency_ms=latency
     )
 
+@app.post("/reindex", response_class=ORJSONResponse, tags=["Admin"])
+async def reindex(x_admin_token: Optional[str] = Header(default=None)):
+    """Rebuild the FAISS index from the source notes and refresh every cached answer."""
+    if not REINDEX_TOKEN:
+        raise HTTPException(status_code=403, detail="Reindexing is disabled; set REINDEX_TOKEN to enable it.")
+    if x_admin_token is None or not secrets.compare_digest(x_admin_token.encode(), REINDEX_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid or missing admin token.")
+    if rag_chain is None:
+        raise HTTPException(status_code=503, detail="Service unavailable.")
+
+    start_time = time.perf_counter_ns()
+    try:
+        documents = await run_in_threadpool(load_documents, DATA_PATH)
+        await run_in_threadpool(build_faiss_index, documents)
+        await run_in_threadpool(rag_chain.reload_index)
+    except Exception as e:
+        logger.error("Error rebuilding FAISS index", exc_info=True)
+        raise HTTPException(status_code=500, detail="Reindex failed.")
+
+    await load_or_precompute_answers(app)
+
+    latency = round((time.perf_counter_ns() - start_time) / 1e6, 2)
+    return {
+        "status": "reindexed",
+        "patients": len(app.state.patient_cache),
+        "latency_ms": latency
+    }
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     logger.error(f"Unhandled system error on path: {request.url}", exc_info=exc)
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={"message": "System error occurred.", "path": str(request.url)}
     )
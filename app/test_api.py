@@ -1,13 +1,17 @@
 """
 Quick test script to validate all API endpoints.
 Run AFTER starting the server with uvicorn.
+All requests are issued concurrently, so it also exercises the server's
+threadpool and request batching under parallel load.
 """
-import requests
+import asyncio
 import json
 
+import httpx
+
 BASE_URL = "http://localhost:8000"
 
-def print_response(endpoint: str, response: dict):
+def print_response(endpoint: str, response: httpx.Response):
     print(f"\n{'='*55}")
     print(f"  {endpoint}")
     print(f"{'='*55}")
@@ -20,44 +24,65 @@ def print_response(endpoint: str, response: dict):
         print(f"  Response: {json.dumps(data, indent=2)}")
 
 
-# Test 1: Health check
-r = requests.get(f"{BASE_URL}/health")
-print_response("GET /health", r)
-
-# Test 2: Ask a question
-r = requests.post(f"{BASE_URL}/ask", json={
-    "question": "What are the symptoms of the stroke patient?",
-    "verbose": False
-})
-print_response("POST /ask", r)
-
-# Test 3: Ask with verbose (shows context)
-r = requests.post(f"{BASE_URL}/ask", json={
-    "question": "Which patient has the lowest oxygen saturation?",
-    "verbose": True
-})
-print_response("POST /ask (verbose)", r)
-
-# Test 4: Chat with history
-r = requests.post(f"{BASE_URL}/chat", json={
-    "question": "What treatment was given to that patient?",
-    "chat_history": [
-        {"role": "user",      "content": "Tell me about patient P010"},
-        {"role": "assistant", "content": "P010 is a stroke patient on tPA..."}
-    ]
-})
-print_response("POST /chat", r)
-
-# Test 5: Risk triage
-r = requests.get(f"{BASE_URL}/risk")
-print_response("GET /risk", r)
-
-# Test 6: Patient summary
-r = requests.get(f"{BASE_URL}/patient/P001")
-print_response("GET /patient/P001", r)
-
-# Test 7: Invalid patient ID
-r = requests.get(f"{BASE_URL}/patient/INVALID")
-print_response("GET /patient/INVALID (should 422)", r)
-
-print("\n✅ All API tests complete!")
+async def main():
+    async with httpx.AsyncClient(base_url=BASE_URL, timeout=60) as client:
+        calls = {
+            # Test 1: Health check
+            "GET /health": client.get("/health"),
+
+            # Test 2: Ask a question
+            "POST /ask": client.post("/ask", json={
+                "question": "What are the symptoms of the stroke patient?",
+                "verbose": False
+            }),
+
+            # Test 3: Ask with verbose (shows context)
+            "POST /ask (verbose)": client.post("/ask", json={
+                "question": "Which patient has the lowest oxygen saturation?",
+                "verbose": True
+            }),
+
+            # Test 4: Chat with history
+            "POST /chat": client.post("/chat", json={
+                "question": "What treatment was given to that patient?",
+                "session_id": "test-session",
+                "chat_history": [
+                    {"role": "user",      "content": "Tell me about patient P010"},
+                    {"role": "assistant", "content": "P010 is a stroke patient on tPA..."}
+                ]
+            }),
+
+            # Test 5: Batched chat sharing one history
+            "POST /chat/batch": client.post("/chat/batch", json={
+                "questions": [
+                    "What medications is that patient on?",
+                    "Are any follow-up imaging studies planned?"
+                ],
+                "chat_history": [
+                    {"role": "user",      "content": "Tell me about patient P010"},
+                    {"role": "assistant", "content": "P010 is a stroke patient on tPA..."}
+                ]
+            }),
+
+            # Test 6: Risk triage
+            "GET /risk": client.get("/risk"),
+
+            # Test 7: Indexed patient IDs
+            "GET /patients": client.get("/patients"),
+
+            # Test 8: Patient summary
+            "GET /patient/P001": client.get("/patient/P001"),
+
+            # Test 9: Invalid patient ID
+            "GET /patient/INVALID (should 422)": client.get("/patient/INVALID"),
+        }
+
+        responses = await asyncio.gather(*calls.values())
+
+    for endpoint, response in zip(calls, responses):
+        print_response(endpoint, response)
+
+    print("\n✅ All API tests complete!")
+
+
+asyncio.run(main())
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+
+from llm_chain import ClinicalRAGChain, question_key
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PendingQuestion:
+    question: str
+    future: asyncio.Future
+
+
+class RequestBatcher:
+    """Coalesces concurrent questions into one batched retrieval pass and a concurrent LLM wave."""
+
+    def __init__(
+        self,
+        chain: ClinicalRAGChain,
+        max_batch_size: int = 32,
+        max_wait_ms: float = 20.0,
+        max_queue_depth: int = 256
+    ):
+        self.chain = chain
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_depth)
+        self._worker: Optional[asyncio.Task] = None
+        self._dispatches: Set[asyncio.Task] = set()
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def start(self) -> None:
+        """Launch the background batching loop on the running event loop."""
+        logger.info(f"Starting request batcher (max_batch={self.max_batch_size}, max_wait={self.max_wait * 1000:.0f}ms)")
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Cancel the batching loop and any in-flight LLM dispatches, failing every unanswered question."""
+        tasks = [self._worker, *self._dispatches] if self._worker else list(self._dispatches)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        # Queued, mid-retrieval and mid-dispatch questions are all still registered here
+        error = RuntimeError("Request batcher stopped before answering.")
+        for future in list(self._inflight.values()):
+            if not future.done():
+                future.set_exception(error)
+
+    async def submit(self, question: str) -> Dict[str, Any]:
+        """
+        Enqueue a question and wait for its answer, joining an identical question that is
+        already queued or in flight. Raises asyncio.QueueFull when saturated.
+        """
+        key = question_key(question)
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.queue.put_nowait(PendingQuestion(question=question, future=future))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        # Shielded so that one disconnected client does not cancel the answer others are awaiting
+        result = await asyncio.shield(future)
+        return {**result, "question": question}
+
+    async def _drain(self) -> List[PendingQuestion]:
+        """Wait for one question, then collect more until the batch fills or the window closes."""
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._drain()
+            try:
+                vectors = await run_in_threadpool(
+                    self.chain.retriever.embed_queries, [pending.question for pending in batch]
+                )
+                misses = self._resolve_cached(batch, vectors)
+                if not misses:
+                    continue
+                contexts = await run_in_threadpool(
+                    self.chain.retrieve_by_vectors, [vector for _, vector in misses]
+                )
+            except Exception as e:
+                logger.error(f"Batched retrieval failed for {len(batch)} questions: {str(e)}", exc_info=True)
+                for pending in batch:
+                    if not pending.future.done():
+                        pending.future.set_exception(e)
+                continue
+
+            # LLM calls run as a separate task so the next batch can be retrieved meanwhile
+            task = asyncio.create_task(self._dispatch(misses, contexts))
+            self._dispatches.add(task)
+            task.add_done_callback(self._dispatches.discard)
+
+    def _resolve_cached(self, batch: List[PendingQuestion], vectors: List[List[float]]) -> List[Tuple[PendingQuestion, List[float]]]:
+        """Answer cache hits immediately and return the questions that still need the pipeline."""
+        misses = []
+        for pending, vector in zip(batch, vectors):
+            cached = self.chain.lookup_cached(pending.question, vector)
+            if cached is None:
+                misses.append((pending, vector))
+            elif not pending.future.done():
+                pending.future.set_result(cached)
+        return misses
+
+    async def _dispatch(self, misses: List[Tuple[PendingQuestion, List[float]]], contexts: List[str]) -> None:
+        results = await asyncio.gather(
+            *[self.chain.agenerate(pending.question, context) for (pending, _), context in zip(misses, contexts)],
+            return_exceptions=True
+        )
+        for (pending, vector), result in zip(misses, results):
+            if isinstance(result, BaseException):
+                if not pending.future.done():
+                    pending.future.set_exception(result)
+                continue
+            self.chain.store_cached(pending.question, vector, result)
+            if not pending.future.done():
+                pending.future.set_result(result)
@@ -0,0 +1,83 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+class SemanticCache:
+    """Stores answers keyed by query embeddings and matches new queries by cosine similarity.
+
+    Entries expire after ``ttl`` seconds and the least recently used entry is evicted once
+    ``max_entries`` is reached. An optional ``scope`` must match exactly for a hit, so that
+    near-identical questions about different patients never share an answer. All operations
+    are serialized, as the RAG chain is called from multiple threadpool workers.
+    """
+
+    CANDIDATES = 4
+
+    def __init__(self, dim: int, threshold: float = 0.95, max_entries: int = 200, ttl: float = 300.0):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.index = faiss.IndexIDMap(faiss.IndexFlatIP(dim))
+        self.entries: "OrderedDict[int, Tuple[float, Hashable, Any]]" = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> np.ndarray:
+        matrix = np.asarray([vector], dtype="float32")
+        faiss.normalize_L2(matrix)
+        return matrix
+
+    def _remove(self, entry_id: int) -> None:
+        del self.entries[entry_id]
+        self.index.remove_ids(np.asarray([entry_id], dtype="int64"))
+
+    def lookup(self, vector: List[float], scope: Hashable = None) -> Optional[Any]:
+        """Return the cached value for the nearest in-scope query if it clears the threshold."""
+        with self._lock:
+            if self.entries:
+                scores, ids = self.index.search(self._normalize(vector), self.CANDIDATES)
+                now = time.monotonic()
+                for score, entry_id in zip(scores[0], ids[0]):
+                    if entry_id == -1 or score < self.threshold:
+                        break
+                    stored_at, entry_scope, value = self.entries[int(entry_id)]
+                    if now - stored_at > self.ttl:
+                        self._remove(int(entry_id))
+                        continue
+                    if entry_scope == scope:
+                        self.entries.move_to_end(int(entry_id))
+                        self.hits += 1
+                        logger.debug(f"Semantic cache hit (similarity={score:.4f})")
+                        return value
+
+            self.misses += 1
+            return None
+
+    def add(self, vector: List[float], value: Any, scope: Hashable = None) -> None:
+        """Store a value, evicting the least recently used entry once the cache is full."""
+        with self._lock:
+            if len(self.entries) >= self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+            entry_id = self._next_id
+            self._next_id += 1
+            self.index.add_with_ids(self._normalize(vector), np.asarray([entry_id], dtype="int64"))
+            self.entries[entry_id] = (time.monotonic(), scope, value)
+
+    def clear(self) -> None:
+        """Drop every cached entry, e.g. after the underlying index is rebuilt."""
+        with self._lock:
+            self.index.reset()
+            self.entries.clear()
@@ -0,0 +1,93 @@
+import numpy as np
+from numba import njit, types
+
+NEWLINE = 10
+SPACE = 32
+PERIOD = 46
+
+# np.frombuffer over bytes yields a read-only array, so the eager signature must accept one
+_BYTE_BUFFER = types.Array(types.uint8, 1, "C", readonly=True)
+
+
+# Compiled eagerly at import (or loaded from the on-disk cache) so the first
+# indexing run does not stall on JIT compilation
+@njit(types.int64[:, :](_BYTE_BUFFER, types.int64, types.int64), cache=True, boundscheck=False)
+def find_splits(buf, chunk_size, overlap):
+    """Scan a UTF-8 byte buffer and return (start, end) offsets of overlapping chunks.
+
+    Boundaries prefer a newline, then a sentence end (". "), then a space, mirroring
+    the separator order previously handed to RecursiveCharacterTextSplitter. Every
+    offset falls on a character start, so no multibyte character is split.
+    """
+    n = buf.shape[0]
+    step = max(min(overlap, chunk_size - overlap), 1)
+    out = np.empty((n // step + 2, 2), np.int64)
+    count = 0
+
+    start = 0
+    while start < n and (buf[start] == SPACE or buf[start] == NEWLINE):
+        start += 1
+
+    while start < n:
+        end = min(start + chunk_size, n)
+
+        if end < n:
+            # Never cut so early that the next chunk would start before this one advanced
+            lo = start + 2 * overlap
+            cut = -1
+            i = end
+            while i > lo:
+                if buf[i - 1] == NEWLINE:
+                    cut = i - 1
+                    break
+                i -= 1
+            if cut < 0:
+                i = end
+                while i > lo + 1:
+                    if buf[i - 2] == PERIOD and buf[i - 1] == SPACE:
+                        cut = i - 1
+                        break
+                    i -= 1
+            if cut < 0:
+                i = end
+                while i > lo:
+                    if buf[i - 1] == SPACE:
+                        cut = i - 1
+                        break
+                    i -= 1
+            if cut > start:
+                end = cut
+            else:
+                # Hard cut: back off over UTF-8 continuation bytes (0b10xxxxxx) to a character start
+                while end > start + 1 and (buf[end] & 0xC0) == 0x80:
+                    end -= 1
+
+        out[count, 0] = start
+        out[count, 1] = end
+        count += 1
+        if end >= n:
+            break
+
+        # Start the overlap on a word boundary so chunks do not open mid-word
+        next_start = end - overlap
+        while next_start < end and buf[next_start - 1] != SPACE and buf[next_start - 1] != NEWLINE:
+            next_start += 1
+        if next_start <= start:
+            next_start = end
+        start = next_start
+        while start < n and (buf[start] == SPACE or buf[start] == NEWLINE):
+            start += 1
+
+    return out[:count]
+
+
+def split_text(text: str, chunk_size: int, overlap: int) -> list:
+    """Split text into overlapping chunks, materialising each substring once."""
+    data = text.encode("utf-8")
+    buf = np.frombuffer(data, dtype=np.uint8)
+    splits = []
+    for start, end in find_splits(buf, chunk_size, overlap):
+        chunk = data[start:end].decode("utf-8").strip()
+        if chunk:
+            splits.append(chunk)
+    return splits
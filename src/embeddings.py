@@ -0,0 +1,196 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+import onnxruntime as ort
+import torch
+from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_core.embeddings import Embeddings
+from transformers import AutoModel, AutoTokenizer
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+EMBED_MODEL = "emilyalsentzer/Bio_ClinicalBERT"
+EMBED_BATCH_SIZE = 128
+ONNX_PATH = Path("models/clinicalbert.onnx")
+MAX_SEQ_LENGTH = 512
+ONNX_OPSET = 17
+
+_embeddings: Optional[Embeddings] = None
+_embeddings_lock = threading.Lock()
+
+
+class OnnxClinicalBERTEmbeddings(Embeddings):
+    """ClinicalBERT served through ONNX Runtime with mean pooling and L2 normalisation."""
+
+    def __init__(self, model_path: Path = ONNX_PATH, batch_size: int = EMBED_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(EMBED_MODEL)
+
+        providers = [
+            provider for provider in ("CUDAExecutionProvider", "CPUExecutionProvider")
+            if provider in ort.get_available_providers()
+        ]
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        num_threads = configured_num_threads()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(str(model_path), sess_options=options, providers=providers)
+        self.input_names = {node.name for node in self.session.get_inputs()}
+        self.dimension = self.session.get_outputs()[0].shape[-1]
+        logger.info(f"Loaded ONNX ClinicalBERT from {model_path} with providers {providers}")
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Encode texts into a float32 matrix of unit-norm sentence embeddings."""
+        batches = []
+        for start in range(0, len(texts), self.batch_size):
+            encoded = self.tokenizer(
+                texts[start:start + self.batch_size],
+                padding=True,
+                truncation=True,
+                max_length=MAX_SEQ_LENGTH,
+                return_tensors="np"
+            )
+            feeds = {name: encoded[name].astype(np.int64) for name in self.input_names}
+            hidden = self.session.run(None, feeds)[0]
+
+            # Mean pooling over real tokens, matching sentence-transformers' default for BERT
+            mask = encoded["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            batches.append(pooled.astype(np.float32))
+
+        if not batches:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        return np.vstack(batches)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.encode([text])[0].tolist()
+
+
+def configured_num_threads() -> Optional[int]:
+    """Intra-op thread count from EMBED_NUM_THREADS, e.g. 1 on serverless or per-core workers."""
+    value = os.getenv("EMBED_NUM_THREADS")
+    return int(value) if value else None
+
+
+def export_onnx(path: Path = ONNX_PATH) -> None:
+    """Export ClinicalBERT to an ONNX graph with dynamic batch and sequence axes."""
+    logger.info(f"Exporting {EMBED_MODEL} to ONNX at {path}")
+    tokenizer = AutoTokenizer.from_pretrained(EMBED_MODEL)
+    model = AutoModel.from_pretrained(EMBED_MODEL).eval()
+    dummy = tokenizer(["chest pain"], return_tensors="pt")
+
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in ("input_ids", "attention_mask", "token_type_ids")}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (dummy["input_ids"], dummy["attention_mask"], dummy["token_type_ids"]),
+            str(path),
+            input_names=["input_ids", "attention_mask", "token_type_ids"],
+            output_names=["last_hidden_state", "pooler_output"],
+            dynamic_axes=dynamic_axes,
+            opset_version=ONNX_OPSET
+        )
+    logger.info("ONNX export complete")
+
+
+def load_huggingface_embeddings() -> HuggingFaceEmbeddings:
+    """
+    Load ClinicalBERT on CUDA in FP16 when available, falling back to CPU. Long-lived
+    servers can set EMBED_TORCH_COMPILE=1 to compile the encoder on first use.
+    """
+    num_threads = configured_num_threads()
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    if torch.cuda.is_available():
+        model_kwargs = {"device": "cuda", "model_kwargs": {"torch_dtype": torch.float16}}
+    else:
+        model_kwargs = {"device": "cpu"}
+
+    logger.info(f"Initializing embedding model: {EMBED_MODEL} on {model_kwargs['device']}")
+    embeddings = HuggingFaceEmbeddings(
+        model_name=EMBED_MODEL,
+        model_kwargs=model_kwargs,
+        encode_kwargs={"batch_size": EMBED_BATCH_SIZE, "normalize_embeddings": True}
+    )
+
+    if os.getenv("EMBED_TORCH_COMPILE") == "1":
+        # Dynamic shapes, because padded sequence length changes with every batch
+        transformer = embeddings.client[0]
+        transformer.auto_model = torch.compile(transformer.auto_model, dynamic=True)
+        logger.info("Compiled ClinicalBERT encoder with torch.compile")
+
+    return embeddings
+
+
+def get_embeddings() -> Embeddings:
+    """Process-wide ClinicalBERT instance: ONNX Runtime when exported, else sentence-transformers."""
+    global _embeddings
+    with _embeddings_lock:
+        if _embeddings is None:
+            if ONNX_PATH.exists():
+                _embeddings = OnnxClinicalBERTEmbeddings(ONNX_PATH)
+            else:
+                _embeddings = load_huggingface_embeddings()
+    return _embeddings
+
+
+def encode_texts(embeddings: Embeddings, texts: List[str]) -> np.ndarray:
+    """Encode texts in large batches straight into a float32 matrix."""
+    if isinstance(embeddings, OnnxClinicalBERTEmbeddings):
+        return embeddings.encode(texts)
+
+    vectors = embeddings.client.encode(
+        texts,
+        batch_size=EMBED_BATCH_SIZE,
+        normalize_embeddings=True,
+        convert_to_numpy=True,
+        show_progress_bar=True
+    )
+    return np.asarray(vectors, dtype="float32")
+
+
+def embedding_cache_key(text: str) -> str:
+    """Content-address a text together with the model that embeds it."""
+    return hashlib.sha256(f"{EMBED_MODEL}|{text}".encode("utf-8")).hexdigest()
+
+
+def save_vector(path: Path, vector: np.ndarray) -> None:
+    """Persist a cached vector atomically, so readers never see a partially written file."""
+    fd, staging = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, vector)
+        os.replace(staging, path)
+    except BaseException:
+        Path(staging).unlink(missing_ok=True)
+        raise
+
+
+def load_vector(path: Path) -> Optional[np.ndarray]:
+    """Read a cached vector; a missing or unreadable file is a cache miss."""
+    try:
+        return np.load(path)
+    except (OSError, ValueError, EOFError):
+        return None
+
+
+def embedding_dimension(embeddings: Embeddings) -> int:
+    if isinstance(embeddings, OnnxClinicalBERTEmbeddings):
+        return embeddings.dimension
+    return embeddings.client.get_sentence_embedding_dimension()
@@ -1,14 +1,40 @@
 import logging
+import os
 import re
+import shutil
+import time
+import uuid
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 
+import faiss
+import numpy as np
 from dotenv import load_dotenv
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.embeddings import Embeddings
 from langchain_core.documents import Document
 
+from chunker import split_text
+from embeddings import (
+    ONNX_PATH, embedding_cache_key, embedding_dimension, encode_texts, export_onnx, get_embeddings, load_vector,
+    save_vector
+)
+
+__all__ = [
+    "DATA_PATH",
+    "INDEX_PATH",
+    "load_documents",
+    "iter_chunks",
+    "embed_with_cache",
+    "create_index",
+    "measure_recall",
+    "build_faiss_index",
+    "persist_index",
+    "main",
+]
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
@@ -16,7 +42,30 @@ load_dotenv()
 
 DATA_PATH = Path("data/sample_clinical_notes.txt")
 INDEX_PATH = Path("faiss_index")
-EMBED_MODEL = "emilyalsentzer/Bio_ClinicalBERT"
+# faiss_index is a symlink to the newest faiss_index.<ns> build; the one before it is kept too
+INDEX_VERSIONS_KEPT = 2
+EMBED_CACHE_DIR = Path("embedding_cache")
+EMBED_STREAM_BATCH = 256
+
+# HNSW graph parameters; corpora above IVF_THRESHOLD switch to an inverted-file index
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+IVF_THRESHOLD = 100_000
+IVF_NLIST = 100
+IVF_NPROBE = 8
+
+# Vectors are stored as 8-bit scalar codes (HNSW) or product-quantized codes (IVF)
+PQ_SUBQUANTIZERS = 48
+PQ_BITS = 8
+VALIDATION_QUERY = "chest pain cardiac"
+VALIDATION_K = 4
+MIN_QUANTIZED_RECALL = 0.75
+
+CHUNK_SIZE = 300
+CHUNK_OVERLAP = 50
+RECORD_SEPARATOR = "---"
+METADATA_FIELD_RE = re.compile(r"(PATIENT_ID|RISK_LEVEL):\s*(\w+)")
 
 
 def load_documents(path: Path) -> List[Dict[str, Any]]:
@@ -26,21 +75,23 @@ def load_documents(path: Path) -> List[Dict[str, Any]]:
         raise FileNotFoundError(f"Data file not found: {path}")
 
     raw_text = path.read_text(encoding="utf-8")
-    records = [r.strip() for r in raw_text.split("---") if r.strip()]
 
     documents = []
-    for record in records:
-        match = re.search(r"PATIENT_ID:\s*(\w+)", record)
-        patient_id = match.group(1) if match else "UNKNOWN"
+    for raw_record in raw_text.split(RECORD_SEPARATOR):
+        record = raw_record.strip()
+        if not record:
+            continue
 
-        risk_match = re.search(r"RISK_LEVEL:\s*(\w+)", record)
-        risk_level = risk_match.group(1) if risk_match else "UNKNOWN"
+        # Single scan collects both fields; the first occurrence of each wins
+        fields: Dict[str, str] = {}
+        for match in METADATA_FIELD_RE.finditer(record):
+            fields.setdefault(match.group(1), match.group(2))
 
         documents.append({
             "page_content": record,
             "metadata": {
-                "patient_id": patient_id,
-                "risk_level": risk_level,
+                "patient_id": fields.get("PATIENT_ID", "UNKNOWN"),
+                "risk_level": fields.get("RISK_LEVEL", "UNKNOWN"),
                 "source": str(path)
             }
         })
@@ -49,55 +100,183 @@ def load_documents(path: Path) -> List[Dict[str, Any]]:
     return documents
 
 
-def chunk_documents(documents: List[Dict[str, Any]]) -> List[Document]:
-    """Split clinical records into overlapping chunks."""
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=300,
-        chunk_overlap=50,
-        separators=["\n", ". ", " "]
-    )
-
-    chunks = []
+def iter_chunks(documents: List[Dict[str, Any]]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Lazily yield (text, metadata) pairs for the overlapping chunks of each record."""
     for doc in documents:
-        splits = splitter.split_text(doc["page_content"])
-        for split in splits:
-            chunks.append(
-                Document(
-                    page_content=split,
-                    metadata=doc["metadata"]
-                )
-            )
-
-    logger.info(f"Created {len(chunks)} document chunks")
-    return chunks
-
-
-def build_faiss_index(chunks: List[Document]) -> FAISS:
-    """Embed chunks and generate a FAISS vector index."""
-    logger.info(f"Initializing embedding model: {EMBED_MODEL}")
-    embeddings = HuggingFaceEmbeddings(
-        model_name=EMBED_MODEL,
-        model_kwargs={"device": "cpu"},
-        encode_kwargs={"normalize_embeddings": True}
-    )
+        for split in split_text(doc["page_content"], CHUNK_SIZE, CHUNK_OVERLAP):
+            yield split, doc["metadata"]
+
+
+def embed_with_cache(embeddings: Embeddings, texts: List[str]) -> np.ndarray:
+    """Embed texts, reusing vectors persisted by earlier indexing runs."""
+    EMBED_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    keys = [embedding_cache_key(text) for text in texts]
+
+    rows: List[Optional[np.ndarray]] = [None] * len(texts)
+    missing = []
+    for i, key in enumerate(keys):
+        rows[i] = load_vector(EMBED_CACHE_DIR / f"{key}.npy")
+        if rows[i] is None:
+            missing.append(i)
+
+    logger.info(f"Embedding cache: {len(texts) - len(missing)} hits, {len(missing)} misses")
+
+    if missing:
+        fresh = encode_texts(embeddings, [texts[i] for i in missing])
+        for i, vector in zip(missing, fresh):
+            save_vector(EMBED_CACHE_DIR / f"{keys[i]}.npy", vector)
+            rows[i] = vector
+
+    return np.vstack(rows).astype("float32", copy=False)
+
+
+def create_index(vectors: np.ndarray, quantize: bool = True) -> faiss.Index:
+    """
+    Construct an approximate nearest-neighbour index sized to the corpus. Embeddings are
+    unit-norm, so indexes rank by inner product, which equals cosine similarity.
+    """
+    num_vectors, dim = vectors.shape
+
+    if num_vectors > IVF_THRESHOLD:
+        logger.info(f"Creating IVF index (nlist={IVF_NLIST}, quantize={quantize}) for {num_vectors} vectors")
+        quantizer = faiss.IndexFlatIP(dim)
+        if quantize:
+            index = faiss.IndexIVFPQ(quantizer, dim, IVF_NLIST, PQ_SUBQUANTIZERS, PQ_BITS, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFFlat(quantizer, dim, IVF_NLIST, faiss.METRIC_INNER_PRODUCT)
+        index.nprobe = IVF_NPROBE
+    else:
+        logger.info(f"Creating HNSW index (M={HNSW_M}, quantize={quantize}) for {num_vectors} vectors")
+        if quantize:
+            index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+
+    if isinstance(index, faiss.IndexIVF):
+        # MMR reconstructs candidate vectors by id, which IVF only supports with a direct map
+        index.make_direct_map()
+
+    return index
+
+
+def measure_recall(index: faiss.Index, vectors: np.ndarray, query: np.ndarray, k: int) -> float:
+    """Fraction of the exact top-k neighbours that the index also returns."""
+    k = min(k, len(vectors))
+    exact = faiss.IndexFlatIP(vectors.shape[1])
+    exact.add(vectors)
+    _, expected = exact.search(query, k)
+    _, found = index.search(query, k)
+    return len(set(expected[0]) & set(found[0])) / k
+
+
+def build_faiss_index(documents: List[Dict[str, Any]]) -> FAISS:
+    """Stream chunks through the embedder in batches and generate a FAISS vector index."""
+    embeddings = get_embeddings()
+    dim = embedding_dimension(embeddings)
+
+    # Chunks are embedded as soon as a batch fills, so only one batch of text is held
+    # alongside a growable float32 buffer instead of a full chunk list plus its vectors.
+    vectors = np.empty((EMBED_STREAM_BATCH, dim), dtype="float32")
+    docstore: Dict[str, Document] = {}
+    index_to_docstore_id: Dict[int, str] = {}
+    num_chunks = 0
+
+    def flush(batch: List[Tuple[str, Dict[str, Any]]]) -> None:
+        nonlocal vectors, num_chunks
+        batch_vectors = embed_with_cache(embeddings, [text for text, _ in batch])
+        end = num_chunks + len(batch)
+        if end > len(vectors):
+            grown = np.empty((max(end, 2 * len(vectors)), dim), dtype="float32")
+            grown[:num_chunks] = vectors[:num_chunks]
+            vectors = grown
+        vectors[num_chunks:end] = batch_vectors
+
+        for position, (text, metadata) in enumerate(batch, start=num_chunks):
+            doc_id = str(uuid.uuid4())
+            # Inputs are generated here, so pydantic validation is skipped; chunks of one
+            # record share that record's metadata dict rather than copying it
+            docstore[doc_id] = Document.model_construct(page_content=text, metadata=metadata)
+            index_to_docstore_id[position] = doc_id
+        num_chunks = end
+
+    batch: List[Tuple[str, Dict[str, Any]]] = []
+    for item in iter_chunks(documents):
+        batch.append(item)
+        if len(batch) == EMBED_STREAM_BATCH:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+    logger.info(f"Embedded {num_chunks} document chunks")
+    vectors = vectors[:num_chunks]
 
     logger.info("Building FAISS index...")
-    vectorstore = FAISS.from_documents(chunks, embeddings)
-    
-    INDEX_PATH.parent.mkdir(parents=True, exist_ok=True)
-    vectorstore.save_local(str(INDEX_PATH))
-    logger.info(f"FAISS index persisted to {INDEX_PATH}")
+    index = create_index(vectors)
 
+    query = np.asarray([embeddings.embed_query(VALIDATION_QUERY)], dtype="float32")
+    recall = measure_recall(index, vectors, query, VALIDATION_K)
+    logger.info(f"Quantized index recall@{VALIDATION_K} on '{VALIDATION_QUERY}': {recall:.2f}")
+    if recall < MIN_QUANTIZED_RECALL:
+        logger.warning("Quantized recall below threshold; rebuilding with full-precision vectors")
+        index = create_index(vectors, quantize=False)
+
+    vectorstore = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(docstore),
+        index_to_docstore_id=index_to_docstore_id,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+    )
+    
+    persist_index(vectorstore)
     return vectorstore
 
 
+def persist_index(vectorstore: FAISS) -> None:
+    """
+    Save the index into a fresh versioned directory and atomically repoint the INDEX_PATH
+    symlink at it, so readers never pair a new index.faiss with an old index.pkl.
+    """
+    version_dir = INDEX_PATH.with_name(f"{INDEX_PATH.name}.{time.time_ns()}")
+    vectorstore.save_local(str(version_dir))
+
+    staged_link = INDEX_PATH.with_name(f".{version_dir.name}.link")
+    os.symlink(version_dir.name, staged_link)
+    if INDEX_PATH.is_dir() and not INDEX_PATH.is_symlink():
+        # One-time migration from the unversioned layout
+        shutil.rmtree(INDEX_PATH)
+    os.replace(staged_link, INDEX_PATH)
+    logger.info(f"FAISS index persisted to {version_dir}")
+
+    # The previous version is kept for workers still loading it; older ones are removed.
+    # Workers that memory-mapped a removed version keep valid inodes until they reload.
+    versions = sorted(
+        (path for path in INDEX_PATH.parent.glob(f"{INDEX_PATH.name}.*") if path.suffix[1:].isdigit() and not path.is_symlink()),
+        key=lambda path: int(path.suffix[1:])
+    )
+    for stale in versions[:-INDEX_VERSIONS_KEPT]:
+        shutil.rmtree(stale, ignore_errors=True)
+
+
 def main():
     logger.info("Starting indexing pipeline")
     
     try:
+        if not ONNX_PATH.exists():
+            try:
+                export_onnx(ONNX_PATH)
+            except Exception as e:
+                logger.warning(f"ONNX export failed, using sentence-transformers instead: {str(e)}")
+
         docs = load_documents(DATA_PATH)
-        chunks = chunk_documents(docs)
-        vectorstore = build_faiss_index(chunks)
+        vectorstore = build_faiss_index(docs)
         
         results = vectorstore.similarity_search("chest pain cardiac", k=1)
         if results:
@@ -1,13 +1,24 @@
+import asyncio
+import atexit
+import functools
+import hashlib
 import os
+import re
 import logging
-from typing import Dict, Any, List
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, FrozenSet, Generator, List, Optional, Tuple
 
+import httpx
+import numpy as np
 from dotenv import load_dotenv
 from langchain_groq import ChatGroq
 from langchain_core.output_parsers import StrOutputParser
 
+from cache import SemanticCache
 from retriever import ClinicalRetriever
-from prompts import get_prompt_for_query
+from prompts import PROMPTS, get_prompt_for_query
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -16,15 +27,55 @@ load_dotenv()
 
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 GROQ_MODEL = "llama-3.3-70b-versatile"
+PATIENT_ID_PATTERN = re.compile(r"\bP\d+\b")
+TOPIC_REUSE_THRESHOLD = 0.9
+MAX_SESSIONS = 1024
+
+# Used when the caller does not inject its own pooled clients
+GROQ_HTTP_TIMEOUT_S = 60
+GROQ_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+WARMUP_TEXT = "warmup"
+
+
+def question_key(question: str) -> str:
+    """Case- and whitespace-insensitive identity used to coalesce duplicate questions and key cached answers."""
+    return " ".join(question.lower().split())
 
 
 class ClinicalRAGChain:
     """Orchestrates the retrieval-augmented generation pipeline."""
 
-    def __init__(self, k: int = 4):
+    def __init__(
+        self,
+        k: int = 4,
+        max_concurrency: int = 8,
+        cache_threshold: float = 0.95,
+        cache_size: int = 200,
+        cache_ttl: float = 300.0,
+        http_client: Optional[httpx.Client] = None,
+        http_async_client: Optional[httpx.AsyncClient] = None,
+        warmup: bool = False
+    ):
         logger.info("Initializing ClinicalRAGChain components")
         self.retriever = ClinicalRetriever()
         self.k = k
+        self.max_concurrency = max_concurrency
+        self._cache_settings = {"threshold": cache_threshold, "max_entries": cache_size, "ttl": cache_ttl}
+        # session_id -> (unit-norm topic embedding, patient IDs named, retrieved context) for follow-up turns
+        self._sessions: "OrderedDict[str, Tuple[np.ndarray, FrozenSet[str], str]]" = OrderedDict()
+        self._sessions_lock = threading.Lock()
+
+        # Own keep-alive HTTP/2 pools unless the caller shares its own, so every call skips the TLS handshake
+        self._owned_http_client = http_client is None
+        self._owned_http_async_client = http_async_client is None
+        self.http_client = http_client or httpx.Client(
+            http2=True, timeout=GROQ_HTTP_TIMEOUT_S, limits=GROQ_HTTP_LIMITS
+        )
+        self.http_async_client = http_async_client or httpx.AsyncClient(
+            http2=True, timeout=GROQ_HTTP_TIMEOUT_S, limits=GROQ_HTTP_LIMITS
+        )
+        if self._owned_http_client or self._owned_http_async_client:
+            atexit.register(self.close)
 
         logger.info(f"Establishing connection to LLM: {GROQ_MODEL}")
         self.llm = ChatGroq(
@@ -32,45 +83,298 @@ class ClinicalRAGChain:
             api_key=GROQ_API_KEY,
             temperature=0.1,
             max_tokens=1024,
+            http_client=self.http_client,
+            http_async_client=self.http_async_client,
         )
         self.output_parser = StrOutputParser()
+        self._chains = {name: prompt | self.llm | self.output_parser for name, prompt in PROMPTS.items()}
         logger.info("LLM connection established")
 
-    def _retrieve_and_format(self, question: str) -> str:
+        if warmup:
+            self.warmup()
+
+    def warmup(self) -> None:
+        """Pay one-time costs before the first real request: encoder load, index page-in, Groq TLS."""
+        start_time = time.perf_counter()
+        vector = self.retriever.embeddings.embed_query(WARMUP_TEXT)
+        self.retriever.mmr_search_by_vector(vector, k=1)
+        try:
+            self.llm.bind(max_tokens=1).invoke(WARMUP_TEXT)
+        except Exception as e:
+            logger.warning(f"LLM warmup failed: {str(e)}")
+        logger.info(f"Warmup completed in {time.perf_counter() - start_time:.2f}s")
+
+    async def awarmup(self) -> None:
+        """Open a pooled connection on the async client used by agenerate()."""
+        try:
+            await self.llm.bind(max_tokens=1).ainvoke(WARMUP_TEXT)
+        except Exception as e:
+            logger.warning(f"Async LLM warmup failed: {str(e)}")
+
+    def close(self) -> None:
+        """Close the HTTP clients this chain created; injected clients are left to their owner."""
+        if self._owned_http_client and not self.http_client.is_closed:
+            self.http_client.close()
+        if self._owned_http_async_client and not self.http_async_client.is_closed:
+            try:
+                asyncio.run(self.http_async_client.aclose())
+            except RuntimeError:
+                # Called from inside a running loop; the pool is released with the process
+                logger.warning("Could not close the async Groq client from a running event loop")
+
+    @functools.cached_property
+    def patient_ids(self) -> FrozenSet[str]:
+        """Patient IDs present in the index; reading this loads the index on first use."""
+        return frozenset(self.retriever.list_patient_ids())
+
+    @functools.cached_property
+    def semantic_cache(self) -> SemanticCache:
+        return SemanticCache(dim=self.retriever.vectorstore.index.d, **self._cache_settings)
+
+    def reload_index(self) -> None:
+        """Reload the FAISS index from disk and refresh the known patient IDs."""
+        self.retriever.load_index()
+        self.patient_ids = frozenset(self.retriever.list_patient_ids())
+        self.semantic_cache.clear()
+        with self._sessions_lock:
+            self._sessions.clear()
+
+    @staticmethod
+    def _patient_ids(question: str) -> FrozenSet[str]:
+        return frozenset(PATIENT_ID_PATTERN.findall(question.upper()))
+
+    @classmethod
+    def _cache_scope(cls, question: str, history: str = "") -> Tuple[str, FrozenSet[str], Optional[str]]:
+        """
+        The normalized question text, the patient IDs it names and a digest of the conversation
+        history it follows; cached answers are only reused when all three match. ClinicalBERT
+        scores questions differing in a single drug name ("aspirin" vs "heparin") above the
+        similarity threshold, so embedding similarity alone is not trusted to pick an answer.
+        """
+        history_digest = hashlib.blake2b(history.encode(), digest_size=16).hexdigest() if history else None
+        return question_key(question), cls._patient_ids(question), history_digest
+
+    def lookup_cached(self, question: str, query_embedding: List[float], history: str = "") -> Optional[Dict[str, Any]]:
+        """Return a cached answer for the same earlier question, asked in the same scope, if any."""
+        cached = self.semantic_cache.lookup(query_embedding, scope=self._cache_scope(question, history))
+        if cached is None:
+            return None
+        return {**cached, "question": question}
+
+    def store_cached(self, question: str, query_embedding: List[float], result: Dict[str, Any], history: str = "") -> None:
+        self.semantic_cache.add(query_embedding, result, scope=self._cache_scope(question, history))
+
+    def _retrieve_and_format(self, query_embedding: List[float]) -> str:
         """Fetch relative documents and inject into context window formatting."""
-        chunks = self.retriever.mmr_search(question, k=self.k)
+        chunks = self.retriever.mmr_search_by_vector(query_embedding, k=self.k)
         return self.retriever.format_context_for_llm(chunks)
 
-    def ask(self, question: str) -> Dict[str, Any]:
-        """Execute a full RAG inference cycle for a given query."""
-        context = self._retrieve_and_format(question)
-        prompt = get_prompt_for_query(question)
-        
-        chain = prompt | self.llm | self.output_parser
-        
+    def _session_context(self, session_id: str, topic: str, query_embedding: List[float]) -> str:
+        """
+        Reuse a session's previous context while its topic stays put and names the same patients,
+        otherwise retrieve afresh. Questions differing only in a patient ID embed almost
+        identically, so the cosine alone would hand one patient's chunks to another's question.
+        """
+        topic_vector = np.asarray(self.retriever.embed_query(topic), dtype="float32")
+        topic_vector /= max(float(np.linalg.norm(topic_vector)), 1e-12)
+        patient_ids = self._patient_ids(topic)
+
+        with self._sessions_lock:
+            previous = self._sessions.get(session_id)
+            if previous is not None:
+                self._sessions.move_to_end(session_id)
+
+        if (
+            previous is not None
+            and previous[1] == patient_ids
+            and float(topic_vector @ previous[0]) >= TOPIC_REUSE_THRESHOLD
+        ):
+            logger.info(f"Reusing retrieved context for session {session_id}")
+            return previous[2]
+
+        context = self._retrieve_and_format(query_embedding)
+        with self._sessions_lock:
+            self._sessions[session_id] = (topic_vector, patient_ids, context)
+            self._sessions.move_to_end(session_id)
+            if len(self._sessions) > MAX_SESSIONS:
+                self._sessions.popitem(last=False)
+        return context
+
+    def stream(
+        self,
+        question: str,
+        session_id: Optional[str] = None,
+        chat_history: Optional[List[Dict[str, str]]] = None
+    ) -> Generator[str, None, Dict[str, Any]]:
+        """
+        Yield answer tokens as the LLM produces them. The generator's return value is the
+        full result dict, and the completed answer is stored in the semantic cache. With a
+        session_id, retrieval is skipped while the question stays close to the one that last
+        triggered it.
+
+        Recent chat_history turns are prepended to the prompt and the retrieval query, but the
+        cache is keyed on the bare question: the encoder truncates long inputs, which would
+        otherwise cut the question off and make different follow-ups look identical.
+        """
+        history = self._format_history(chat_history) if chat_history else ""
+        query = self._enrich_with_history(question, history) if history else question
+
+        question_embedding = self.retriever.embed_query(question)
+        cached = self.lookup_cached(question, question_embedding, history)
+        if cached is not None:
+            yield cached["answer"]
+            return cached
+
+        query_embedding = self.retriever.embed_query(query) if history else question_embedding
+        if session_id is None:
+            context = self._retrieve_and_format(query_embedding)
+        else:
+            context = self._session_context(session_id, question, query_embedding)
+        chain = self._chains[get_prompt_for_query(query)]
+
+        tokens: List[str] = []
+        start_time = time.perf_counter()
+        try:
+            for token in chain.stream({
+                "context": context,
+                "question": query
+            }):
+                tokens.append(token)
+                yield token
+        except Exception as e:
+            logger.error(f"Inference failed: {str(e)}", exc_info=True)
+            raise
+
+        elapsed = time.perf_counter() - start_time
+        logger.info(f"Streamed {len(tokens)} tokens in {elapsed:.2f}s ({len(tokens) / max(elapsed, 1e-9):.1f} tokens/s)")
+
+        result = self._build_result(question, context, "".join(tokens))
+        self.store_cached(question, question_embedding, result, history)
+        return result
+
+    def ask(
+        self,
+        question: str,
+        session_id: Optional[str] = None,
+        chat_history: Optional[List[Dict[str, str]]] = None
+    ) -> Dict[str, Any]:
+        """Execute a full RAG inference cycle for a given query by draining stream()."""
+        tokens = self.stream(question, session_id=session_id, chat_history=chat_history)
+        while True:
+            try:
+                next(tokens)
+            except StopIteration as done:
+                return done.value
+
+    def _build_result(self, question: str, context: str, answer: str) -> Dict[str, Any]:
+        return {
+            "question": question,
+            "context": context,
+            "answer": answer,
+            "model": GROQ_MODEL,
+            "chunks_retrieved": self.k
+        }
+
+    def ask_many(
+        self,
+        questions: List[str],
+        return_exceptions: bool = False,
+        chat_history: Optional[List[Dict[str, str]]] = None
+    ) -> List[Any]:
+        """
+        Answer several questions with one batched embedding pass and one LLM batch per
+        prompt template, dispatched concurrently up to max_concurrency. A shared chat_history
+        is handled as in stream().
+        """
+        history = self._format_history(chat_history) if chat_history else ""
+        queries = [self._enrich_with_history(q, history) for q in questions] if history else questions
+
+        vectors = self.retriever.embed_queries(questions)
+        results: List[Any] = [self.lookup_cached(q, v, history) for q, v in zip(questions, vectors)]
+        pending = [i for i, result in enumerate(results) if result is None]
+        if history and pending:
+            query_vectors = self.retriever.embed_queries([queries[i] for i in pending])
+        else:
+            query_vectors = [vectors[i] for i in pending]
+        contexts = dict(zip(pending, self.retrieve_by_vectors(query_vectors)))
+
+        groups: Dict[str, List[int]] = {}
+        for i in pending:
+            groups.setdefault(get_prompt_for_query(queries[i]), []).append(i)
+
+        for key, indices in groups.items():
+            answers = self._chains[key].batch(
+                [{"context": contexts[i], "question": queries[i]} for i in indices],
+                config={"max_concurrency": self.max_concurrency},
+                return_exceptions=return_exceptions
+            )
+            for i, answer in zip(indices, answers):
+                if isinstance(answer, Exception):
+                    logger.error(f"Batched inference failed: {str(answer)}")
+                    results[i] = answer
+                    continue
+                results[i] = self._build_result(questions[i], contexts[i], answer)
+                self.store_cached(questions[i], vectors[i], results[i], history)
+
+        return results
+
+    def retrieve_by_vectors(self, vectors: List[List[float]]) -> List[str]:
+        """Format retrieved context for questions that have already been embedded."""
+        return [
+            self.retriever.format_context_for_llm(self.retriever.mmr_search_by_vector(vector, k=self.k))
+            for vector in vectors
+        ]
+
+    async def agenerate(self, question: str, context: str, prompt_key: Optional[str] = None) -> Dict[str, Any]:
+        """Generate an answer asynchronously from pre-retrieved context."""
+        chain = self._chains[prompt_key or get_prompt_for_query(question)]
+
         try:
-            answer = chain.invoke({
+            answer = await chain.ainvoke({
                 "context": context,
                 "question": question
             })
-            
-            return {
-                "question": question,
-                "context": context,
-                "answer": answer,
-                "model": GROQ_MODEL,
-                "chunks_retrieved": self.k
-            }
         except Exception as e:
-            logger.error(f"Inference failed: {str(e)}", exc_info=True)
+            logger.error(f"Async inference failed: {str(e)}", exc_info=True)
             raise
 
-    def ask_with_history(self, question: str, chat_history: List[Dict[str, str]]) -> Dict[str, Any]:
+        return self._build_result(question, context, answer)
+
+    @staticmethod
+    def _format_history(chat_history: List[Dict[str, str]]) -> str:
+        """Render the last four conversation turns."""
+        return "".join(
+            f"{'User' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}\n"
+            for msg in chat_history[-4:]
+        )
+
+    @staticmethod
+    def _enrich_with_history(question: str, history: str) -> str:
+        """Prefix the question with rendered conversation history."""
+        return f"Conversation History:\n{history}\nCurrent Query: {question}"
+
+    def ask_with_history(
+        self,
+        question: str,
+        chat_history: List[Dict[str, str]],
+        session_id: Optional[str] = None
+    ) -> Dict[str, Any]:
         """Execute RAG inference utilizing recent chat history for context."""
-        history_str = ""
-        for msg in chat_history[-4:]:
-            role = "User" if msg["role"] == "user" else "Assistant"
-            history_str += f"{role}: {msg['content']}\n"
+        return self.ask(question, session_id=session_id, chat_history=chat_history)
+
+    def ask_many_with_history(
+        self,
+        questions: List[str],
+        chat_history: List[Dict[str, str]]
+    ) -> List[Any]:
+        """Batched ask_with_history() for several questions that share one conversation history."""
+        return self.ask_many(questions, return_exceptions=True, chat_history=chat_history)
 
-        enriched_question = f"Conversation History:\n{history_str}\nCurrent Query: {question}"
-        return self.ask(enriched_question)
+    def stream_with_history(
+        self,
+        question: str,
+        chat_history: List[Dict[str, str]],
+        session_id: Optional[str] = None
+    ) -> Generator[str, None, Dict[str, Any]]:
+        """Streaming counterpart of ask_with_history()."""
+        return self.stream(question, session_id=session_id, chat_history=chat_history)
@@ -1,3 +1,5 @@
+import re
+
 from langchain_core.prompts import ChatPromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate
 
 CLINICAL_SYSTEM_PROMPT = """You are ClinicalBot, an AI decision-support assistant designed for clinical chart review.
@@ -9,13 +11,16 @@ SYSTEM DIRECTIVES:
 4. Reference specific Patient IDs (e.g., P001) for traceability.
 5. Explicitly flag HIGH risk patients.
 6. Append a disclaimer recommending physician verification for all clinical decisions.
+"""
 
-CLINICAL CONTEXT:
+# Kept separate from the byte-identical system prompt above so every request shares that prefix
+CLINICAL_CONTEXT_PROMPT = """CLINICAL CONTEXT:
 {context}
 """
 
 CLINICAL_QA_PROMPT = ChatPromptTemplate.from_messages([
     SystemMessagePromptTemplate.from_template(CLINICAL_SYSTEM_PROMPT),
+    SystemMessagePromptTemplate.from_template(CLINICAL_CONTEXT_PROMPT),
     HumanMessagePromptTemplate.from_template(
         "Query: {question}\n\nProvide a concise and accurate response based on the clinical context."
     )
@@ -23,6 +28,7 @@ CLINICAL_QA_PROMPT = ChatPromptTemplate.from_messages([
 
 RISK_ASSESSMENT_PROMPT = ChatPromptTemplate.from_messages([
     SystemMessagePromptTemplate.from_template(CLINICAL_SYSTEM_PROMPT),
+    SystemMessagePromptTemplate.from_template(CLINICAL_CONTEXT_PROMPT),
     HumanMessagePromptTemplate.from_template(
         """Execute a patient risk stratification based on the following query: {question}
 
@@ -38,6 +44,7 @@ RISK_ASSESSMENT_PROMPT = ChatPromptTemplate.from_messages([
 
 PATIENT_SUMMARY_PROMPT = ChatPromptTemplate.from_messages([
     SystemMessagePromptTemplate.from_template(CLINICAL_SYSTEM_PROMPT),
+    SystemMessagePromptTemplate.from_template(CLINICAL_CONTEXT_PROMPT),
     HumanMessagePromptTemplate.from_template(
         """Synthesize clinical details for: {question}
 
@@ -54,6 +61,7 @@ PATIENT_SUMMARY_PROMPT = ChatPromptTemplate.from_messages([
 
 TREATMENT_PROMPT = ChatPromptTemplate.from_messages([
     SystemMessagePromptTemplate.from_template(CLINICAL_SYSTEM_PROMPT),
+    SystemMessagePromptTemplate.from_template(CLINICAL_CONTEXT_PROMPT),
     HumanMessagePromptTemplate.from_template(
         """Review the clinical records and detail the treatment plan regarding: {question}
 
@@ -66,17 +74,23 @@ TREATMENT_PROMPT = ChatPromptTemplate.from_messages([
     )
 ])
 
-def get_prompt_for_query(question: str) -> ChatPromptTemplate:
-    """Dynamically route queries to the most appropriate prompt template."""
-    q_lower = question.lower()
-
-    if any(keyword in q_lower for keyword in ["risk", "triage", "urgent", "critical", "priority"]):
-        return RISK_ASSESSMENT_PROMPT
-
-    if any(keyword in q_lower for keyword in ["summarize", "summary", "overview", "patient"]):
-        return PATIENT_SUMMARY_PROMPT
+PROMPTS = {
+    "risk": RISK_ASSESSMENT_PROMPT,
+    "summary": PATIENT_SUMMARY_PROMPT,
+    "treatment": TREATMENT_PROMPT,
+    "default": CLINICAL_QA_PROMPT,
+}
 
-    if any(keyword in q_lower for keyword in ["medication", "drug", "treatment", "prescribed", "plan", "dosage"]):
-        return TREATMENT_PROMPT
+# One alternation scanned once per query; group names are PROMPTS keys, listed by routing priority
+ROUTE_PRIORITY = ("risk", "summary", "treatment")
+# Zero-width lookahead so overlapping keywords (e.g. "patientreatment") are all seen
+KEYWORD_RE = re.compile(
+    r"(?=(?P<risk>risk|triage|urgent|critical|priority)"
+    r"|(?P<summary>summarize|summary|overview|patient)"
+    r"|(?P<treatment>medication|drug|treatment|prescribed|plan|dosage))"
+)
 
-    return CLINICAL_QA_PROMPT
+def get_prompt_for_query(question: str) -> str:
+    """Dynamically route queries to the key of the most appropriate prompt template in PROMPTS."""
+    matched = {match.lastgroup for match in KEYWORD_RE.finditer(question.lower())}
+    return next((key for key in ROUTE_PRIORITY if key in matched), "default")
@@ -1,11 +1,23 @@
+import functools
 import logging
+import os
+import pickle
+import threading
+import time
+from collections import defaultdict
 from pathlib import Path
 from dataclasses import dataclass
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple
 
+import faiss
+import numpy as np
+import tiktoken
 from dotenv import load_dotenv
 from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.embeddings import Embeddings
+
+from embeddings import EMBED_MODEL, embedding_cache_key, get_embeddings, load_vector, save_vector
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -13,7 +25,63 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 INDEX_PATH = Path("faiss_index")
-EMBED_MODEL = "emilyalsentzer/Bio_ClinicalBERT"
+HNSW_EF_SEARCH = 64
+IVF_NPROBE = 8
+MMR_FETCH_K = 20
+QUERY_CACHE_DIR = Path("query_cache")
+QUERY_CACHE_SIZE = 1024
+# On-disk query vectors unused for QUERY_CACHE_MAX_AGE_S are dropped, then the oldest beyond
+# QUERY_CACHE_MAX_FILES; checked on the first and every QUERY_CACHE_PRUNE_EVERY-th write
+QUERY_CACHE_MAX_FILES = 10_000
+QUERY_CACHE_MAX_AGE_S = 7 * 24 * 3600
+QUERY_CACHE_PRUNE_EVERY = 256
+MAX_CONTEXT_TOKENS = 2048
+# Not Llama 3's own tokenizer, but close enough to budget prompt size
+TOKEN_ENCODING = "cl100k_base"
+TOKENIZER_RETRY_S = 300
+
+
+_encoder: Optional[tiktoken.Encoding] = None
+_encoder_retry_at = 0.0
+_encoder_lock = threading.Lock()
+
+
+def _token_encoder() -> Optional[tiktoken.Encoding]:
+    """The context-budget tokenizer. Only a successful load is kept; failures are retried later."""
+    global _encoder, _encoder_retry_at
+    # Non-blocking so requests skip trimming rather than queue behind a slow download
+    if _encoder is None and time.monotonic() >= _encoder_retry_at and _encoder_lock.acquire(blocking=False):
+        try:
+            if _encoder is None:
+                _encoder = tiktoken.get_encoding(TOKEN_ENCODING)
+        except Exception as e:
+            _encoder_retry_at = time.monotonic() + TOKENIZER_RETRY_S
+            logger.warning(
+                f"Tokenizer '{TOKEN_ENCODING}' unavailable, context will not be trimmed "
+                f"(retrying in {TOKENIZER_RETRY_S}s): {str(e)}"
+            )
+        finally:
+            _encoder_lock.release()
+    return _encoder
+
+
+def prune_query_cache(max_files: int = QUERY_CACHE_MAX_FILES, max_age_s: float = QUERY_CACHE_MAX_AGE_S) -> int:
+    """Delete expired and least recently used query vectors from disk; returns how many were removed."""
+    try:
+        entries = [(entry.stat().st_mtime, entry.path) for entry in os.scandir(QUERY_CACHE_DIR) if entry.name.endswith(".npy")]
+    except FileNotFoundError:
+        return 0
+
+    entries.sort()
+    cutoff = time.time() - max_age_s
+    expired = sum(1 for mtime, _ in entries if mtime < cutoff)
+    doomed = entries[:max(expired, len(entries) - max_files)]
+    for _, path in doomed:
+        # Another worker may be pruning the same directory
+        Path(path).unlink(missing_ok=True)
+    if doomed:
+        logger.info(f"Pruned {len(doomed)} cached query embeddings")
+    return len(doomed)
 
 
 @dataclass
@@ -27,32 +95,143 @@ class RetrievedChunk:
         return f"[{self.patient_id} | Risk: {self.risk_level}]\n{self.content[:150]}..."
 
 
+@dataclass(frozen=True)
+class IndexSnapshot:
+    """One loaded index build. It is swapped as a whole on reload, so a search that started on
+    the old build resolves its FAISS ids through the old docstore."""
+    vectorstore: FAISS
+    risk_ids: Dict[str, np.ndarray]
+    loaded_from: str
+
+
 class ClinicalRetriever:
     """Manages vector embeddings and FAISS index retrieval operations."""
 
-    def __init__(self):
+    def __init__(self, max_context_tokens: int = MAX_CONTEXT_TOKENS):
         logger.info(f"Initializing ClinicalRetriever with model: {EMBED_MODEL}")
-        self.embeddings = HuggingFaceEmbeddings(
-            model_name=EMBED_MODEL,
-            model_kwargs={"device": "cpu"},
-            encode_kwargs={"normalize_embeddings": True}
-        )
+        self.max_context_tokens = max_context_tokens
+        # Per-instance so the cache does not pin the retriever through a class-level lru_cache
+        self._embed_normalized = functools.lru_cache(maxsize=QUERY_CACHE_SIZE)(self._embed_persisted)
+        self._query_cache_writes = 0
+        self._formatted_chunks: Dict[Tuple[str, str, str], Tuple[str, int]] = {}
+
+    @functools.cached_property
+    def embeddings(self) -> Embeddings:
+        """ClinicalBERT, loaded on first use rather than at construction."""
+        return get_embeddings()
 
+    @functools.cached_property
+    def snapshot(self) -> IndexSnapshot:
+        """The persisted FAISS index, memory-mapped on first use. Read it once per operation."""
+        return self._read_index()
+
+    @property
+    def vectorstore(self) -> FAISS:
+        return self.snapshot.vectorstore
+
+    def load_index(self) -> None:
+        """Reload the persisted FAISS index after a rebuild."""
+        self.snapshot = self._read_index()
+        self._formatted_chunks = {}
+
+    def index_stale(self) -> bool:
+        """Whether INDEX_PATH now points at a newer build than the loaded one, e.g. one made by another worker."""
+        return "snapshot" in self.__dict__ and os.path.realpath(INDEX_PATH) != self.snapshot.loaded_from
+
+    @staticmethod
+    def _group_by_risk(vectorstore: FAISS) -> Dict[str, np.ndarray]:
+        """FAISS ids of the indexed chunks grouped by risk level, for in-index filtering."""
+        grouped = defaultdict(list)
+        docstore = vectorstore.docstore
+        for faiss_id, doc_id in vectorstore.index_to_docstore_id.items():
+            grouped[docstore.search(doc_id).metadata.get("risk_level", "UNKNOWN")].append(faiss_id)
+        return {risk_level: np.asarray(ids, dtype="int64") for risk_level, ids in grouped.items()}
+
+    def _read_index(self) -> IndexSnapshot:
         if not INDEX_PATH.exists():
             logger.error(f"FAISS index path not found: {INDEX_PATH}")
             raise FileNotFoundError(f"FAISS index not found at '{INDEX_PATH}'.")
 
-        logger.info("Loading FAISS index into memory...")
-        self.vectorstore = FAISS.load_local(
-            str(INDEX_PATH),
-            self.embeddings,
-            allow_dangerous_deserialization=True
+        # Resolved once, so both files come from the same build even if the symlink is swapped meanwhile
+        index_dir = Path(os.path.realpath(INDEX_PATH))
+
+        # IO_FLAG_MMAP_IFC maps every index type in place (IO_FLAG_MMAP only maps IVF inverted
+        # lists), so HNSW graphs and codes stay in the page cache shared by all uvicorn workers
+        logger.info("Memory-mapping FAISS index...")
+        index = faiss.read_index(str(index_dir / "index.faiss"), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+        with open(index_dir / "index.pkl", "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+
+        # Indexes built before the switch to inner product still rank by L2 distance
+        if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+            distance_strategy = DistanceStrategy.MAX_INNER_PRODUCT
+        else:
+            distance_strategy = DistanceStrategy.EUCLIDEAN_DISTANCE
+
+        vectorstore = FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id,
+            distance_strategy=distance_strategy
         )
+        self._configure_search_params(vectorstore.index)
         logger.info("FAISS index loaded successfully.")
+        return IndexSnapshot(vectorstore, self._group_by_risk(vectorstore), str(index_dir))
+
+    @staticmethod
+    def _configure_search_params(index: faiss.Index, fetch_k: int = MMR_FETCH_K) -> None:
+        """Apply query-time search breadth for approximate indexes."""
+        if isinstance(index, faiss.IndexHNSW):
+            # The graph walk must keep at least twice the MMR candidate pool to return it reliably
+            index.hnsw.efSearch = max(fetch_k * 2, HNSW_EF_SEARCH)
+        elif isinstance(index, faiss.IndexIVF):
+            index.nprobe = IVF_NPROBE
+
+    def list_patient_ids(self) -> Set[str]:
+        """Collect the distinct patient IDs present in the indexed chunks."""
+        return {
+            doc.metadata["patient_id"]
+            for doc in self.vectorstore.docstore._dict.values()
+            if doc.metadata.get("patient_id", "UNKNOWN") != "UNKNOWN"
+        }
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        """Collapse whitespace so trivially different spellings share one embedding."""
+        return " ".join(query.split())
+
+    def _embed_persisted(self, query: str) -> Tuple[float, ...]:
+        """Embed a normalized query, reusing vectors persisted by earlier processes."""
+        cache_file = QUERY_CACHE_DIR / f"{embedding_cache_key(query)}.npy"
+        # Missing, pruned meanwhile by another worker, or unreadable: all count as a miss
+        cached = load_vector(cache_file)
+        if cached is not None:
+            try:
+                # The mtime doubles as last use, so pruning evicts the least recently used vectors
+                os.utime(cache_file)
+            except OSError:
+                pass
+            return tuple(cached.tolist())
+
+        vector = self.embeddings.embed_query(query)
+        self._persist_query_vector(query, vector)
+        return tuple(vector)
+
+    def _persist_query_vector(self, query: str, vector: List[float]) -> None:
+        QUERY_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        save_vector(QUERY_CACHE_DIR / f"{embedding_cache_key(query)}.npy", np.asarray(vector, dtype="float32"))
+        if self._query_cache_writes % QUERY_CACHE_PRUNE_EVERY == 0:
+            prune_query_cache()
+        self._query_cache_writes += 1
+
+    def embed_query(self, query: str) -> List[float]:
+        """Embed a query through the in-memory LRU and on-disk query embedding caches."""
+        return list(self._embed_normalized(self.normalize_query(query)))
 
     def similarity_search(self, query: str, k: int = 4) -> List[RetrievedChunk]:
-        """Execute a standard cosine similarity search."""
-        docs_scores = self.vectorstore.similarity_search_with_score(query, k=k)
+        """Execute a cosine similarity search; higher scores are more similar."""
+        docs_scores = self.vectorstore.similarity_search_with_score_by_vector(self.embed_query(query), k=k)
         return [
             RetrievedChunk(
                 content=doc.page_content,
@@ -63,40 +242,136 @@ class ClinicalRetriever:
             for doc, score in docs_scores
         ]
 
-    def mmr_search(self, query: str, k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5) -> List[RetrievedChunk]:
+    def embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """
+        Embed several queries through the same caches as embed_query(), encoding only the
+        queries with no persisted vector in a single batched pass (one GPU forward per wave).
+        Vectors held by the LRU are normally also on disk, so an existence check finds the hits.
+        """
+        normalized = [self.normalize_query(query) for query in queries]
+        misses = list(dict.fromkeys(
+            query for query in normalized
+            if not (QUERY_CACHE_DIR / f"{embedding_cache_key(query)}.npy").exists()
+        ))
+        if misses:
+            for query, vector in zip(misses, self.embeddings.embed_documents(misses)):
+                self._persist_query_vector(query, vector)
+        # Misses now load from disk into the LRU; a file pruned meanwhile is just re-embedded
+        return [list(self._embed_normalized(query)) for query in normalized]
+
+    def mmr_search(self, query: str, k: int = 4, fetch_k: int = MMR_FETCH_K, lambda_mult: float = 0.5) -> List[RetrievedChunk]:
         """Execute a Max Marginal Relevance (MMR) search for diversity."""
-        docs = self.vectorstore.max_marginal_relevance_search(
-            query, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult
+        return self.mmr_search_by_vector(
+            self.embed_query(query), k=k, fetch_k=fetch_k, lambda_mult=lambda_mult
         )
+
+    @staticmethod
+    def _mmr_select(candidates: np.ndarray, query: np.ndarray, k: int, lambda_mult: float) -> List[int]:
+        """Greedy MMR over unit-norm candidate rows using one query matmul and one Gram matrix."""
+        query_sims = candidates @ query
+        pairwise_sims = candidates @ candidates.T
+
+        selected = [int(np.argmax(query_sims))]
+        max_sim_to_selected = pairwise_sims[selected[0]].copy()
+        available = np.ones(len(candidates), dtype=bool)
+        available[selected[0]] = False
+
+        while len(selected) < min(k, len(candidates)):
+            scores = lambda_mult * query_sims - (1 - lambda_mult) * max_sim_to_selected
+            scores[~available] = -np.inf
+            best = int(np.argmax(scores))
+            selected.append(best)
+            available[best] = False
+            np.maximum(max_sim_to_selected, pairwise_sims[best], out=max_sim_to_selected)
+
+        return selected
+
+    def mmr_search_by_vector(self, embedding: List[float], k: int = 4, fetch_k: int = MMR_FETCH_K, lambda_mult: float = 0.5) -> List[RetrievedChunk]:
+        """Execute an MMR search for a query that has already been embedded."""
+        vectorstore = self.vectorstore
+        index = vectorstore.index
+        query = np.asarray([embedding], dtype="float32")
+        faiss.normalize_L2(query)
+
+        _, ids = index.search(query, fetch_k)
+        ids = ids[0][ids[0] != -1]
+        if not len(ids):
+            return []
+
+        candidates = index.reconstruct_batch(ids)
+        faiss.normalize_L2(candidates)
+        query_sims = candidates @ query[0]
+
         return [
-            RetrievedChunk(
-                content=doc.page_content,
-                patient_id=doc.metadata.get("patient_id", "UNKNOWN"),
-                risk_level=doc.metadata.get("risk_level", "UNKNOWN")
-            )
-            for doc in docs
+            self._chunk_for_id(vectorstore, int(ids[position]), float(query_sims[position]))
+            for position in self._mmr_select(candidates, query[0], k, lambda_mult)
         ]
 
+    @staticmethod
+    def _chunk_for_id(vectorstore: FAISS, faiss_id: int, score: float = 0.0) -> RetrievedChunk:
+        """Resolve a FAISS id through the docstore of the build that returned it."""
+        doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[faiss_id])
+        return RetrievedChunk(
+            content=doc.page_content,
+            patient_id=doc.metadata.get("patient_id", "UNKNOWN"),
+            risk_level=doc.metadata.get("risk_level", "UNKNOWN"),
+            score=round(score, 4)
+        )
+
+    def _format_chunk(self, chunk: RetrievedChunk, encoder: Optional[tiktoken.Encoding]) -> Tuple[str, int]:
+        """Formatted source block for a chunk and its token count, memoized per chunk."""
+        # Bounded by the corpus size and reset whenever the index is reloaded
+        key = (chunk.patient_id, chunk.risk_level, chunk.content)
+        cached = self._formatted_chunks.get(key)
+        if cached is None:
+            formatted = f"[Source: {chunk.patient_id} | Risk: {chunk.risk_level}]\n{chunk.content}"
+            cached = (formatted, len(encoder.encode(formatted)) if encoder is not None else 0)
+            self._formatted_chunks[key] = cached
+        return cached
+
     def format_context_for_llm(self, chunks: List[RetrievedChunk]) -> str:
-        """Format retrieved chunks into a standardized context block for LLM inference."""
-        formatted_chunks = [
-            f"[Source: {chunk.patient_id} | Risk: {chunk.risk_level}]\n{chunk.content}"
-            for chunk in chunks
-        ]
+        """
+        Format retrieved chunks into a standardized context block for LLM inference. Chunks
+        are taken in retrieval rank order until max_context_tokens is spent; the chunk that
+        crosses the budget is cut to fit and lower-ranked ones are dropped.
+        """
+        encoder = _token_encoder()
+        remaining = self.max_context_tokens
+        formatted_chunks = []
+        for chunk in chunks:
+            formatted, num_tokens = self._format_chunk(chunk, encoder)
+            if encoder is not None and num_tokens > remaining:
+                if remaining > 0:
+                    formatted_chunks.append(encoder.decode(encoder.encode(formatted)[:remaining]))
+                logger.info(f"Context trimmed to {self.max_context_tokens} tokens")
+                break
+            remaining -= num_tokens
+            formatted_chunks.append(formatted)
         return "\n\n".join(formatted_chunks)
 
-    def search_by_risk_level(self, risk_level: str) -> List[RetrievedChunk]:
-        """Filter the vector store by specific risk level metadata."""
-        docs = self.vectorstore.similarity_search(
-            query=risk_level,
-            k=20,
-            filter={"risk_level": risk_level.upper()}
-        )
+    def search_by_risk_level(self, risk_level: str, k: int = 20) -> List[RetrievedChunk]:
+        """
+        Search only the chunks of one risk level, filtering inside FAISS with an ID selector.
+        Scores are the index metric: cosine similarity, or L2 distance for legacy indexes.
+        """
+        snapshot = self.snapshot
+        ids = snapshot.risk_ids.get(risk_level.upper())
+        if ids is None:
+            return []
+
+        index = snapshot.vectorstore.index
+        selector = faiss.IDSelectorBatch(ids)
+        if isinstance(index, faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=max(k * 2, HNSW_EF_SEARCH))
+        elif isinstance(index, faiss.IndexIVF):
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=IVF_NPROBE)
+        else:
+            params = faiss.SearchParameters(sel=selector)
+
+        query = np.asarray([self.embed_query(risk_level)], dtype="float32")
+        distances, found = index.search(query, min(k, len(ids)), params=params)
         return [
-            RetrievedChunk(
-                content=doc.page_content,
-                patient_id=doc.metadata.get("patient_id", "UNKNOWN"),
-                risk_level=doc.metadata.get("risk_level", "UNKNOWN")
-            )
-            for doc in docs
+            self._chunk_for_id(snapshot.vectorstore, int(faiss_id), float(distance))
+            for faiss_id, distance in zip(found[0], distances[0])
+            if faiss_id != -1
         ]
@@ -3,8 +3,10 @@
 echo "Building FAISS Index..."
 python src/indexer.py
 
-# Start the FastAPI backend in the background
-uvicorn app.main:app --host 0.0.0.0 --port 8000 &
+# Start the FastAPI backend in the background, one worker per core by default.
+# Each worker memory-maps the same FAISS index, so the pages are shared.
+API_WORKERS="${API_WORKERS:-$(nproc)}"
+uvicorn app.main:app --host 0.0.0.0 --port 8000 --workers "$API_WORKERS" --loop uvloop --http httptools &
 
 # Wait for the backend to start
 sleep 5
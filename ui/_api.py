@@ -0,0 +1,155 @@
+"""HTTP helpers shared by the Streamlit UI: one pooled client, cached probes and API calls."""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import orjson
+import streamlit as st
+
+logger = logging.getLogger(__name__)
+
+API_URL = "http://localhost:8000"
+CLIENT_VERSION = "1.0.0"
+
+# Built once and reused by every call; keep-alive is implied by the pooled client (and HTTP/2 forbids the header)
+DEFAULT_HEADERS = {"Accept": "application/json", "X-Client-Version": CLIENT_VERSION}
+# Request bodies are serialized with orjson, so their content type is set explicitly
+JSON_BODY_HEADERS = {"Content-Type": "application/json"}
+SSE_HEADERS = {**JSON_BODY_HEADERS, "Accept": "text/event-stream"}
+ASK_STREAM_PATH = "/ask/stream"
+CHAT_STREAM_PATH = "/chat/stream"
+CHAT_BATCH_PATH = "/chat/batch"
+RISK_PATH = "/risk"
+PATIENTS_PATH = "/patients"
+HEALTH_PATH = "/health"
+
+# Gateway errors and a saturated backend are retried in the transport, before the user sees them
+RETRY_STATUSES = frozenset({502, 503, 504})
+RETRY_ATTEMPTS = 2
+RETRY_BACKOFF_S = 0.2
+
+class RetryTransport(httpx.HTTPTransport):
+    """HTTP transport that also retries transient gateway responses, with exponential backoff."""
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        for attempt in range(RETRY_ATTEMPTS):
+            response = super().handle_request(request)
+            if response.status_code not in RETRY_STATUSES:
+                return response
+            # Releases the connection back to the pool, so the retry reuses it
+            response.close()
+            logger.warning(f"{request.method} {request.url.path} returned {response.status_code}, retrying")
+            time.sleep(RETRY_BACKOFF_S * 2 ** attempt)
+        return super().handle_request(request)
+
+@st.cache_resource
+def get_client() -> httpx.Client:
+    """Pooled keep-alive client shared by every rerun and session of this Streamlit process."""
+    # The transport owns pooling and retries: retries=1 re-attempts a failed connect (e.g. a
+    # backend restart), RetryTransport the 502/503/504 responses
+    transport = RetryTransport(
+        http2=True,
+        retries=1,
+        limits=httpx.Limits(max_connections=10, max_keepalive_connections=10)
+    )
+    return httpx.Client(base_url=API_URL, headers=DEFAULT_HEADERS, timeout=30, transport=transport)
+
+def api_chat_stream(question: str, history: list, meta: dict):
+    """Yield answer tokens as they arrive; the closing event's model and latency (or an error) land in meta."""
+    endpoint, payload = (CHAT_STREAM_PATH, {"question": question, "chat_history": history}) if history \
+        else (ASK_STREAM_PATH, {"question": question, "verbose": False})
+    event = "message"
+    try:
+        with get_client().stream("POST", endpoint, content=orjson.dumps(payload), headers=SSE_HEADERS) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                elif line.startswith("data:"):
+                    data = orjson.loads(line[5:])
+                    if event == "message":
+                        yield data["token"]
+                    elif event == "done":
+                        meta.update(data)
+                    else:
+                        meta["error"] = "Inference failed while streaming the answer."
+                elif not line:
+                    event = "message"
+    except httpx.HTTPError as e:
+        logger.error(f"API request failed: {e}")
+        meta["error"] = "API connection failed."
+
+def api_chat_batch(questions: list, history: list) -> list:
+    """Answer several questions in one /chat/batch call; a failed question, or every one if the call fails, carries an error."""
+    try:
+        response = get_client().post(
+            CHAT_BATCH_PATH,
+            content=orjson.dumps({"questions": questions, "chat_history": history}),
+            headers=JSON_BODY_HEADERS,
+            timeout=60
+        )
+        response.raise_for_status()
+        return orjson.loads(response.content)["results"]
+    except httpx.HTTPError as e:
+        logger.error(f"API request failed: {e}")
+        return [{"error": "API connection failed."}] * len(questions)
+
+# Failures raise out of the cached fetchers, so only successful responses are memoized
+@st.cache_data(ttl=120, show_spinner=False)
+def fetch_risk() -> dict:
+    response = get_client().get(RISK_PATH, timeout=45)
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+@st.cache_data(ttl=300, show_spinner=False, max_entries=64)
+def fetch_patient(pid: str) -> dict:
+    response = get_client().get(f"/patient/{pid}")
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_patient_ids() -> list:
+    response = get_client().get(PATIENTS_PATH, timeout=5)
+    response.raise_for_status()
+    return orjson.loads(response.content)["patient_ids"]
+
+def api_patient_ids() -> list:
+    try:
+        return fetch_patient_ids()
+    except Exception as e:
+        logger.error(f"API request failed: {e}")
+        return []
+
+def api_risk() -> dict:
+    try:
+        return fetch_risk()
+    except Exception as e:
+        logger.error(f"API request failed: {e}")
+        return {"error": "Risk analytics failed."}
+
+def api_patient(pid: str) -> dict:
+    try:
+        return fetch_patient(pid)
+    except httpx.HTTPStatusError as he:
+        if he.response.status_code in (404, 422):
+            return {"error": f"Invalid format or ID not found: {pid}"}
+        return {"error": f"HTTP Error: {he}"}
+    except Exception as e:
+        return {"error": str(e)}
+
+@st.cache_data(ttl=10, show_spinner=False)
+def api_health() -> bool:
+    try:
+        response = get_client().get(HEALTH_PATH, timeout=5)
+        return response.status_code == 200
+    except httpx.HTTPError:
+        return False
+
+@st.cache_resource
+def get_executor() -> ThreadPoolExecutor:
+    """Worker threads for API calls that can overlap with rendering."""
+    return ThreadPoolExecutor(max_workers=10)
+
+def fmt_latency(ms: float) -> str:
+    return f"{ms:.0f}ms" if ms < 1000 else f"{ms/1000:.1f}s"
@@ -1,7 +1,15 @@
 import streamlit as st
-import requests
 import logging
-from datetime import datetime
+import re
+import time
+from collections import deque
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Optional
+
+from _api import (
+    api_chat_batch, api_chat_stream, api_health, api_patient, api_patient_ids, api_risk, fetch_patient, fetch_risk, fmt_latency, get_executor
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -12,224 +20,258 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-API_URL = "http://localhost:8000"
-
-st.markdown("""
-<style>
-    .stApp {
-        background-color: #f4f6f9;
-        font-family: 'Inter', sans-serif;
-    }
-    .main-header {
-        font-size: 2.2rem;
-        font-weight: 700;
-        color: #2c3e50;
-        margin-bottom: 0px;
-    }
-    .sub-header {
-        font-size: 1.0rem;
-        color: #7f8c8d;
-        font-weight: 500;
-        margin-bottom: 2rem;
-    }
-    [data-testid="stSidebar"] {
-        background-color: #ffffff;
-        border-right: 1px solid #e0e6ed;
-    }
-    .stat-box {
-        background: #ffffff;
-        border-radius: 8px;
-        padding: 1.0rem;
-        border-left: 4px solid #3498db;
-        box-shadow: 0 2px 4px rgba(0,0,0,0.05);
-        margin-bottom: 1rem;
-    }
-    .stChatMessage {
-        border-radius: 10px;
-        padding: 1rem;
-        background-color: #ffffff;
-        border: 1px solid #eaebec;
-        box-shadow: 0 1px 2px rgba(0,0,0,0.02);
-    }
-    .latency-tag {
-        font-size: 0.8rem;
-        color: #95a5a6;
-    }
-</style>
-""", unsafe_allow_html=True)
+CSS_PATH = Path(__file__).parent / "style.css"
+QUICK_SELECT_LIMIT = 10
+# (label, widget key) pairs, built once rather than on every rerun
+PRESET_QUERIES = tuple((query, f"q_{query[:15]}") for query in (
+    "Are there any acute interventions required?",
+    "Detail the medication regimen for diabetic patients.",
+    "Synthesize high-risk patient indicators."
+))
+# Answers containing none of these are rendered as plain text
+MARKDOWN_CHARS = frozenset("*_`#[]|>-")
+# Same rule the API enforces on /patient/{id}; malformed IDs are rejected without a round trip
+PID_PATTERN = re.compile(r"P[0-9]+")
+# Chat submissions arriving within DEBOUNCE_S of each other are sent together, CHAT_BATCH_SIZE per request
+DEBOUNCE_S = 0.1
+CHAT_BATCH_SIZE = 4
+# Rendered chat history is capped at MAX_MESSAGES; only the last HISTORY_MESSAGES are sent to the API
+MAX_MESSAGES = 40
+HISTORY_MESSAGES = 10
+
+@st.cache_resource
+def load_css() -> str:
+    return CSS_PATH.read_text()
+
+# st.html with only a <style> tag adds no visible element; the stylesheet is read from disk once
+st.html(f"<style>{load_css()}</style>")
 
 
 if "messages" not in st.session_state:
-    st.session_state.messages = []
+    st.session_state.messages = deque(maxlen=MAX_MESSAGES)
 if "total_queries" not in st.session_state:
     st.session_state.total_queries = 0
-if "latencies" not in st.session_state:
-    st.session_state.latencies = []
-
-
-def api_ask(question: str) -> dict:
-    try:
-        response = requests.post(f"{API_URL}/ask", json={"question": question, "verbose": False}, timeout=30)
-        response.raise_for_status()
-        return response.json()
-    except Exception as e:
-        logger.error(f"API request failed: {e}")
-        return {"error": "API error. Please ensure the backend is running."}
-
-def api_chat(question: str, history: list) -> dict:
+if "latency_sum" not in st.session_state:
+    st.session_state.latency_sum = 0.0
+if "pending" not in st.session_state:
+    st.session_state.pending = []
+
+
+@st.fragment
+def status_fragment(health_future: Future):
+    """Health badge; its refresh button reruns only this fragment."""
+    if st.button("Refresh status", use_container_width=True):
+        api_health.clear()
+        health_future = get_executor().submit(api_health)
     try:
-        response = requests.post(f"{API_URL}/chat", json={"question": question, "chat_history": history}, timeout=30)
-        response.raise_for_status()
-        return response.json()
-    except Exception as e:
-        logger.error(f"API request failed: {e}")
-        return {"error": "API connection failed."}
-
-def api_risk() -> dict:
-    try:
-        response = requests.get(f"{API_URL}/risk", timeout=45)
-        response.raise_for_status()
-        return response.json()
-    except Exception as e:
-        logger.error(f"API request failed: {e}")
-        return {"error": "Risk analytics failed."}
-
-def api_patient(pid: str) -> dict:
-    try:
-        response = requests.get(f"{API_URL}/patient/{pid}", timeout=30)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.HTTPError as he:
-        if response.status_code == 422:
-            return {"error": f"Invalid format or ID not found: {pid}"}
-        return {"error": f"HTTP Error: {he}"}
-    except Exception as e:
-        return {"error": str(e)}
-
-def api_health() -> bool:
-    try:
-        response = requests.get(f"{API_URL}/health", timeout=5)
-        return response.status_code == 200
-    except:
-        return False
-
-def fmt_latency(ms: float) -> str:
-    return f"{ms:.0f}ms" if ms < 1000 else f"{ms/1000:.1f}s"
-
-
-with st.sidebar:
-    st.markdown("### Clinical RAG System")
-    st.caption("v1.0.0 | Llama-3.3-70b")
-    st.divider()
-
-    st.markdown("#### System Status")
-    if api_health():
+        api_online = health_future.result(timeout=5)
+    except Exception:
+        api_online = False
+    if api_online:
         st.success("API Connected")
     else:
         st.error("API Offline")
 
-    st.divider()
-
-    st.markdown("#### Operation Mode")
-    mode = st.radio("mode", options=["Chat Interface", "Risk Stratification", "Chart Review"], label_visibility="collapsed")
-
-    st.divider()
-
-    st.markdown("#### Session Telemetry")
-    avg_latency = sum(st.session_state.latencies) / len(st.session_state.latencies) if st.session_state.latencies else 0
+@st.fragment
+def telemetry_fragment():
+    avg_latency = st.session_state.latency_sum / st.session_state.total_queries if st.session_state.total_queries else 0
 
     col1, col2 = st.columns(2)
     col1.metric("Queries", st.session_state.total_queries)
     col2.metric("Avg Latency", fmt_latency(avg_latency) if avg_latency else "N/A")
 
     if st.button("Clear Session Data", use_container_width=True):
-        st.session_state.messages = []
+        st.session_state.messages.clear()
         st.session_state.total_queries = 0
-        st.session_state.latencies = []
+        st.session_state.latency_sum = 0.0
         st.rerun()
 
-st.markdown('<p class="main-header">Clinical Inference Engine</p>', unsafe_allow_html=True)
-st.markdown('<p class="sub-header">Retrieval-Augmented Generation utilizing ClinicalBERT and FAISS</p>', unsafe_allow_html=True)
-
-
-if mode == "Chat Interface":
-    preset_queries = [
-        "Are there any acute interventions required?",
-        "Detail the medication regimen for diabetic patients.",
-        "Synthesize high-risk patient indicators."
-    ]
+def render_answer(text: str):
+    """Show plain-text answers with st.text, skipping the Markdown pipeline unless the text needs it."""
+    if MARKDOWN_CHARS.isdisjoint(text):
+        st.text(text)
+    else:
+        st.markdown(text)
+
+def record_turn(question: str, result: Optional[dict] = None):
+    """Append a question and, if it was answered, the answer and its telemetry to the history."""
+    st.session_state.messages.append({"role": "user", "content": question})
+    if result is None:
+        return
+    latency = result.get("latency_ms", 0)
+    st.session_state.messages.append({
+        "role": "assistant",
+        "content": result["answer"],
+        "latency": latency,
+        "model": result.get("model", "llama-3.3-70b")
+    })
+    st.session_state.total_queries += 1
+    st.session_state.latency_sum += latency
+
+def render_message(msg: dict):
+    """One past chat bubble with its latency tag."""
+    with st.chat_message(msg["role"]):
+        render_answer(msg["content"])
+        if msg["role"] == "assistant" and "latency" in msg:
+            st.markdown(f'<p class="latency-tag">Process time: {fmt_latency(msg["latency"])} | Model: {msg["model"]}</p>', unsafe_allow_html=True)
+
+def queue_chat_input():
+    """chat_input callback: hand the submitted text to the chat fragment."""
+    st.session_state.queued_input = st.session_state.chat_input
+
+@st.fragment
+def chat_fragment():
+    """Chat history and suggestions; a suggestion click reruns only this fragment."""
     st.markdown("**Suggested Queries:**")
-    cols = st.columns(len(preset_queries))
-    for idx, sample in enumerate(preset_queries):
-        if cols[idx].button(sample, use_container_width=True):
-            st.session_state["prefill"] = sample
+    cols = st.columns(len(PRESET_QUERIES))
+    for col, (sample, key) in zip(cols, PRESET_QUERIES):
+        if col.button(sample, key=key, use_container_width=True):
+            st.session_state.queued_input = sample
 
     st.divider()
 
     for msg in st.session_state.messages:
-        with st.chat_message(msg["role"]):
-            st.markdown(msg["content"])
-            if msg["role"] == "assistant" and "latency" in msg:
-                st.markdown(f'<p class="latency-tag">Process time: {fmt_latency(msg["latency"])} | Model: {msg["model"]}</p>', unsafe_allow_html=True)
+        render_message(msg)
 
-    prefill = st.session_state.pop("prefill", None)
-    user_input = st.chat_input("Input clinical query...") or prefill
+    # Questions from an interrupted run that are still waiting to be sent
+    for question in st.session_state.pending:
+        with st.chat_message("user"):
+            st.markdown(question)
+
+    user_input = st.session_state.pop("queued_input", None)
 
     if user_input:
         with st.chat_message("user"):
             st.markdown(user_input)
-        
-        st.session_state.messages.append({"role": "user", "content": user_input})
-        history = [{"role": m["role"], "content": m["content"]} for m in st.session_state.messages[:-1]]
 
-        with st.chat_message("assistant"):
-            with st.spinner("Executing query pipeline..."):
-                result = api_chat(user_input, history) if history else api_ask(user_input)
+        st.session_state.pending.append(user_input)
+        if len(st.session_state.pending) < CHAT_BATCH_SIZE:
+            # Another submission during this window interrupts the run at its next st call,
+            # and the rerun sends both questions together
+            time.sleep(DEBOUNCE_S)
 
-            if "error" in result:
-                st.error(result["error"])
+    pending = st.session_state.pending
+    while pending:
+        questions = pending[:CHAT_BATCH_SIZE]
+        history = [{"role": m["role"], "content": m["content"]} for m in list(st.session_state.messages)[-HISTORY_MESSAGES:]]
+        with st.chat_message("assistant"):
+            if len(questions) == 1:
+                meta = {}
+                answer = st.write_stream(api_chat_stream(questions[0], history, meta))
+                results = [meta if "error" in meta else {**meta, "answer": answer}]
             else:
-                st.markdown(result["answer"])
-                latency = result.get("latency_ms", 0)
-                model = result.get("model", "llama-3.3-70b")
-                st.markdown(f'<p class="latency-tag">Process time: {fmt_latency(latency)} | Model: {model}</p>', unsafe_allow_html=True)
+                with st.spinner(f"Answering {len(questions)} queries..."):
+                    results = api_chat_batch(questions, history)
+
+            # Dequeued only once answered, with no st call in between, so an interrupted run
+            # leaves its questions queued for the next one and never records them twice
+            del pending[:len(questions)]
+            for question, result in zip(questions, results):
+                record_turn(question, None if "error" in result else result)
+
+            # Later reruns draw these from history, each answer under its own question
+            for question, result in zip(questions, results):
+                if len(questions) > 1:
+                    st.markdown(f"**{question}**")
+                if "error" in result:
+                    st.error(result["error"])
+                    continue
+                if len(questions) > 1:
+                    render_answer(result["answer"])
+                st.markdown(f'<p class="latency-tag">Process time: {fmt_latency(result.get("latency_ms", 0))} | Model: {result.get("model", "llama-3.3-70b")}</p>', unsafe_allow_html=True)
+
+
+# Probe health in the background while the rest of the sidebar is laid out
+health_future = get_executor().submit(api_health)
+
+with st.sidebar:
+    st.markdown("### Clinical RAG System")
+    st.caption("v1.0.0 | Llama-3.3-70b")
+    st.divider()
+
+    st.markdown("#### System Status")
+    status_fragment(health_future)
+
+    st.divider()
+
+    st.markdown("#### Operation Mode")
+    mode = st.radio("mode", options=["Chat Interface", "Risk Stratification", "Chart Review"], label_visibility="collapsed")
 
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": result["answer"],
-                    "latency": latency,
-                    "model": model
-                })
-                st.session_state.total_queries += 1
-                st.session_state.latencies.append(latency)
+    st.divider()
+
+    st.markdown("#### Session Telemetry")
+    # Refreshed on the next full rerun; suggestion clicks only rerun the chat fragment
+    telemetry_fragment()
+
+st.markdown('<p class="main-header">Clinical Inference Engine</p>', unsafe_allow_html=True)
+st.markdown('<p class="sub-header">Retrieval-Augmented Generation utilizing ClinicalBERT and FAISS</p>', unsafe_allow_html=True)
+
+
+if mode == "Chat Interface":
+    chat_fragment()
+    # Outside the fragment so Streamlit pins it to the bottom of the page; inside one it renders
+    # inline and new messages appear below it. Its value is passed on through queued_input, as
+    # fragment reruns would replay a stale argument.
+    st.chat_input("Input clinical query...", key="chat_input", on_submit=queue_chat_input)
 
 
 elif mode == "Risk Stratification":
     st.markdown("#### Patient Population Analytics")
     st.write("Executes cross-sectional evaluation of loaded clinical records to identify acuity metrics.")
 
+    if st.button("Force refresh", key="refresh_risk"):
+        fetch_risk.clear()
+        st.session_state.pop("risk_future", None)
+
+    # Fetched as soon as this mode is shown, so the button usually returns instantly
+    if "risk_future" not in st.session_state:
+        st.session_state.risk_future = get_executor().submit(api_risk)
+
     if st.button("Initialize Stratification Process", type="primary", use_container_width=True):
         with st.spinner("Running analytics..."):
-            result = api_risk()
+            result = st.session_state.pop("risk_future").result()
 
         if "error" in result:
             st.error(result["error"])
         else:
             st.success("Analysis complete.")
-            st.markdown(result["answer"])
+            render_answer(result["answer"])
 
 
 elif mode == "Chart Review":
     st.markdown("#### Individual Chart Retrieval")
     st.write("Input patient identifier to generate structured clinical summary.")
 
+    patient_ids = api_patient_ids()
+    # Warm the response cache for every chart in parallel; later lookups return from cache
+    if patient_ids and "patients_prefetched" not in st.session_state:
+        for patient_id in patient_ids:
+            get_executor().submit(api_patient, patient_id)
+        st.session_state.patients_prefetched = True
+
+    def select_patient(patient_id: str):
+        st.session_state.pid_input = patient_id
+        st.session_state.pid_lookup = True
+
+    if patient_ids:
+        st.markdown("**Quick Select:**")
+        quick_ids = patient_ids[:QUICK_SELECT_LIMIT]
+        for col, patient_id in zip(st.columns(len(quick_ids)), quick_ids):
+            col.button(patient_id, on_click=select_patient, args=(patient_id,), use_container_width=True)
+
     col1, col2 = st.columns([4, 1])
     with col1:
-        pid = st.text_input("pid", placeholder="Identifier format: P001", label_visibility="collapsed", max_chars=10).upper().strip()
+        pid = st.text_input("pid", key="pid_input", placeholder="Identifier format: P001", label_visibility="collapsed", max_chars=10).upper().strip()
     with col2:
-        lookup = st.button("Execute", type="primary", use_container_width=True)
+        lookup = st.button("Execute", type="primary", use_container_width=True) or st.session_state.pop("pid_lookup", False)
+
+    if st.button("Force refresh", key="refresh_patient"):
+        fetch_patient.clear()
+        lookup = bool(pid)
 
-    if lookup and pid:
+    if lookup and pid and not PID_PATTERN.fullmatch(pid):
+        st.error(f"Invalid format or ID not found: {pid}")
+    elif lookup and pid:
         with st.spinner(f"Retrieving data for {pid}..."):
             result = api_patient(pid)
 
@@ -238,4 +280,4 @@ elif mode == "Chart Review":
         else:
             st.success("Record processing successful.")
             st.markdown(f"#### Synthesis output: {pid}")
-            st.markdown(result["answer"])
+            render_answer(result["answer"])